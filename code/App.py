@@ -5,10 +5,12 @@ import cv2
 import numpy as np
 import threading
 import time
-import ast
+import re
 import csv
 import json
+import pickle
 import datetime
+import functools
 from collections import deque
 from PyQt5.QtWidgets import (
     QApplication, QMainWindow, QLabel, QVBoxLayout, QWidget,
@@ -17,7 +19,7 @@ from PyQt5.QtWidgets import (
     QSplitter, QAction, QScrollArea, QToolButton, QInputDialog, QMenu, QActionGroup, QComboBox
 )
 from PyQt5.QtGui import QImage, QPixmap, QColor, QIcon
-from PyQt5.QtCore import Qt, QTimer, pyqtSignal, QObject, QRectF, QPointF, QPropertyAnimation, QTranslator
+from PyQt5.QtCore import Qt, pyqtSignal, QObject, QRectF, QPointF, QPropertyAnimation, QTranslator
 import pyqtgraph as pg
 import os
 
@@ -27,9 +29,10 @@ dist_coeffs = None
 ref_image = None
 ref_gray = None
 ref_keypoints = None
+ref_pts = None
 ref_descriptors = None
 orb = None
-flann = None
+matcher = None
 map1_frame = None
 map2_frame = None
 roi_frame = None
@@ -40,51 +43,139 @@ frame_lock = threading.Lock()
 frame_available = threading.Event()
 shared_data = {'frame': None, 'gaze_x': None, 'gaze_y': None, 'frame_num': None, 'score_right': None, 'score_left': None, 'system_time': None}
 
+# 縮小画像の画素あたりの平均絶対差がこれ未満ならシーンが動いていないとみなしてホモグラフィを再利用する
+MOTION_THRESHOLD = 1.0
+# ホモグラフィを続けて再利用する最大フレーム数
+HOMOGRAPHY_REFRESH_FRAMES = 30
+# ヒートマップは基準画像の1/HEATMAP_DOWNSCALEの解像度でぼかしてから拡大して合成する
+HEATMAP_DOWNSCALE = 4
+# ヒートマップのぼかしのシグマと、floatの画像でOpenCVが使うカーネルの半径（シグマ15で121タップ）
+HEATMAP_SIGMA = 15
+HEATMAP_KERNEL_RADIUS = 60
+# OpenCV 4.5以降ではホモグラフィの推定にMAGSAC++を使う（RANSACより少ない反復で収束する）
+USE_MAGSAC = hasattr(cv2, 'USAC_MAGSAC')
+
+# OpenCLのデバイスが使える場合だけT-API（cv2.UMat）の処理を有効にする
+def opencl_available():
+    if not cv2.ocl.haveOpenCL():
+        return False
+    cv2.ocl.setUseOpenCL(True)
+    return cv2.ocl.useOpenCL()
+
+# カメラ行列や歪み係数の入力文字列を数値配列に変換する関数
+def parse_array_text(text):
+    # Pythonのタプル表記と末尾のカンマも受け付け、Pythonの式としてではなくJSONとして解析する
+    text = text.strip().replace('(', '[').replace(')', ']')
+    text = re.sub(r',\s*\]', ']', text)
+    return np.array(json.loads(text), dtype=np.float64)
+
+# ディレクトリ内のフォルダ名のリストを返す関数
+def list_subdirectories(path):
+    # os.scandirで一度だけ読み、名前ごとのstatを行わない（DirEntry.is_dir()は読み込み時の種別を使う）
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return []
+
 # 歪み補正マップの事前計算関数
 def precompute_undistort_map(image_shape):
     h, w = image_shape[:2]
+    # 同じフレームサイズとカメラパラメータのマップはキャッシュから返す
+    return build_undistort_map(h, w, camera_matrix.tobytes(), dist_coeffs.tobytes())
+
+@functools.lru_cache(maxsize=4)
+def build_undistort_map(h, w, camera_matrix_bytes, dist_coeffs_bytes):
+    camera_matrix_key = np.frombuffer(camera_matrix_bytes, dtype=np.float64).reshape(3, 3)
+    dist_coeffs_key = np.frombuffer(dist_coeffs_bytes, dtype=np.float64)
+    # 歪み係数がすべて0ならフレームをそのまま使うので、マップは作らない
+    if not np.any(dist_coeffs_key):
+        return None, None, (0, 0, w, h), camera_matrix_key
     # alpha=0で黒い部分がなくなるように調整
-    new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(camera_matrix, dist_coeffs, (w,h), alpha=0, centerPrincipalPoint=1)
-    map1, map2 = cv2.initUndistortRectifyMap(camera_matrix, dist_coeffs, None, new_camera_mtx, (w,h), cv2.CV_16SC2)
+    new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(camera_matrix_key, dist_coeffs_key, (w,h), alpha=0, centerPrincipalPoint=1)
+    map1, map2 = cv2.initUndistortRectifyMap(camera_matrix_key, dist_coeffs_key, None, new_camera_mtx, (w,h), cv2.CV_16SC2)
+    # 歪み補正後はroiの部分しか使わないので、マップをroiに切り出してremapが捨てる部分を計算しないようにする
+    x, y, roi_w, roi_h = roi
+    map1 = np.ascontiguousarray(map1[y:y+roi_h, x:x+roi_w])
+    map2 = np.ascontiguousarray(map2[y:y+roi_h, x:x+roi_w])
     return map1, map2, roi, new_camera_mtx
 
+# 時刻の正時のタイムスタンプ（タイムゾーンと夏時間のずれは正時にしか変わらないため、datetimeの変換は1時間に1回で済む）
+@functools.lru_cache(maxsize=32)
+def hour_start_timestamp(year, month, day, hour):
+    return datetime.datetime(year, month, day, hour).timestamp()
+
 # GUIスレッドと通信するためのシグナルクラス
 class Communicate(QObject):
     update_image = pyqtSignal()
 
+# グラフに表示する最大ポイント数
+GRAPH_POINTS = 100
+
+# 記録するCSVファイルの列
+CSV_FIELDNAMES = ['Frame', 'PicNum', 'GazeX', 'GazeY', 'AOI', 'ScoreRight', 'ScoreLeft', 'SystemTime']
+
+# JPEGとPNGの先頭バイト（base64の文字列がこれで始まることはない）
+IMAGE_SIGNATURES = (b'\xff\xd8', b'\x89PNG')
+
 # フレームを連続的に受信する関数
-def receive_frames(zmq_address):
+def receive_frames(zmq_address, comm):
     global shared_data
     # ZeroMQの設定（サブスクライバーとして設定）
     context = zmq.Context()
     socket = context.socket(zmq.SUB)
+    # 古いフレームを溜めない（zmq.CONFLATEはマルチパートのメッセージに対応しないので、
+    # キューを1件にして、溜まっていた古いメッセージは下で読み捨てる。connectの前に設定する必要がある）
+    socket.setsockopt(zmq.RCVHWM, 1)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
     socket.connect(zmq_address)
     socket.setsockopt_string(zmq.SUBSCRIBE, "")
 
     while True:
-        message = socket.recv_pyobj()
+        parts = socket.recv_multipart(copy=False)
+        while socket.poll(0):
+            parts = socket.recv_multipart(copy=False)
+
+        if len(parts) == 1:
+            # 従来の形式：pickleした辞書の'image'にbase64でエンコードした（またはそのままの）画像
+            message = pickle.loads(parts[0].buffer)
+            encoded_image = message['image']
+            # JPEG/PNGのバイト列がそのまま送られてきた場合はbase64デコードを省略
+            if isinstance(encoded_image, str) or not encoded_image.startswith(IMAGE_SIGNATURES):
+                encoded_image = base64.b64decode(encoded_image)
+        else:
+            # マルチパートの形式：JSONのメタデータと画像のバイト列（base64なし）
+            message = json.loads(parts[0].bytes)
+            encoded_image = parts[1].buffer
+
         frame_num = message['frame']
         gaze_x = message['gaze_x']
         gaze_y = message['gaze_y']
         score_right = message.get('score_right', 0)
         score_left = message.get('score_left', 0)
         system_time = message.get('system_time', None)
-        encoded_image = message['image']
 
-        # 画像データをデコード
-        decoded_image = base64.b64decode(encoded_image)
-        np_image = np.frombuffer(decoded_image, dtype=np.uint8)
-        frame_temp = cv2.imdecode(np_image, cv2.IMREAD_COLOR)
+        # 画像データをデコード（'shape'があればエンコードされていないBGRのフレームとしてそのまま使う）
+        np_image = np.frombuffer(encoded_image, dtype=np.uint8)
+        if 'shape' in message:
+            frame_temp = np_image.reshape(message['shape'])
+        else:
+            frame_temp = cv2.imdecode(np_image, cv2.IMREAD_COLOR)
 
         with frame_lock:
-            shared_data['frame'] = frame_temp.copy()
+            shared_data['frame'] = frame_temp
             shared_data['gaze_x'] = gaze_x
             shared_data['gaze_y'] = gaze_y
             shared_data['frame_num'] = frame_num  # PicNumとして使用
             shared_data['score_right'] = score_right
             shared_data['score_left'] = score_left
             shared_data['system_time'] = system_time
-        frame_available.set()
+        # 描画待ちのフレームがないときだけGUIスレッドに通知する。描画前に届いたフレームは
+        # 同じ通知で最新のものだけが描画されるので、シグナルがフレームごとに溜まることはない
+        if not frame_available.is_set():
+            frame_available.set()
+            comm.update_image.emit()
 
 # AOIを管理するクラス
 class AOI:
@@ -164,17 +255,34 @@ class GazeApp(QMainWindow):
         self.gaze_point_size = 10
         self.gaze_point_color = (0, 0, 255)  # 赤色（BGR）
         self.gaze_point_opacity = 1.0        # 透明度（1.0:不透明、0.0:透明）
+        self.gaze_sprite = None              # 視線ポイントの円の色のタイルとマスク（サイズか色が変わったら作り直す）
         self.show_fps = True
         self.previous_time = time.time()
         self.fps = 0
         self.overlay_scene = False           # シーンカメラのオーバーレイ表示フラグ
         self.scene_opacity = 0.5             # シーンカメラの透明度
         self.aoi_list = []                   # AOIのリスト
+        self.aoi_bboxes = np.empty((0, 4))   # 各AOIの(left, top, right, bottom)
+        self.aoi_corners = np.empty((0, 4, 2), dtype=np.int32)  # 各AOIの四隅（描画用）
+        self.aoi_bbox_owners = []            # aoi_bboxesを作成したときのAOIのリスト
         self.drawing_aoi = False             # AOIを描画中かどうか
         self.aoi_start_point = None          # AOIの開始点
         self.is_configured = False           # 設定完了フラグ
         self.reset_requested = False         # カウントリセット要求フラグ
         self.previous_frame_shape = None
+        self.undistort_buffer = None         # 歪み補正結果の再利用バッファ
+        self.crop_projection = None          # 正規化カメラ座標からクロップ後の画素座標への変換行列
+        self.key_thumbnail = None            # 直前にホモグラフィを計算したフレームの縮小画像
+        self.last_homography = None          # そのフレームのホモグラフィ行列
+        self.homography_reuse_count = 0      # そのホモグラフィを続けて再利用したフレーム数
+        self.display_buffer = None           # 表示画像の再利用バッファ
+        self.warp_buffer = None              # 基準画像の座標系に変換したシーンカメラのフレームの再利用バッファ
+        self.use_opencl = False              # 画像処理をOpenCL（cv2.UMat）で行うか
+        self.rgb_buffer = None               # BGR888に対応しないQtでのRGB変換用バッファ
+        self.pixmaps = [QPixmap(), QPixmap()]  # 交互に書き込んで表示するピックスマップ
+        self.pixmap_index = 0
+        self.label_mapping = None            # ラベル座標から画像座標への (offset_x, offset_y, scale_x, scale_y)
+        self.label_mapping_key = None        # label_mappingを計算したときのラベルとピックスマップの大きさ
 
         # ドキュメントフォルダ内のGazeVisualizeSoftwareフォルダのパスを取得
         self.base_directory = os.path.join(os.path.expanduser('~/Documents'), 'GazeVisualizeSoftware')
@@ -188,19 +296,23 @@ class GazeApp(QMainWindow):
         # 視線データの保持
         # self.gaze_history = []               # 視線座標の履歴
         self.max_history = 100               # デフォルトの履歴フレーム数
-        self.gaze_history = deque(maxlen=self.max_history)  # 視線座標の履歴
+        self.history_capacity = 1000         # 最大の履歴フレーム数（履歴スライダーの最大値）
+        self.gaze_history = np.empty((self.history_capacity, 2), dtype=np.int32)  # 視線座標のリングバッファ
+        self.gaze_head = 0                   # gaze_historyの次の書き込み位置
+        self.gaze_count = 0                  # gaze_historyの有効な点の数（max_history以下）
         self.heatmap_opacity = 0.5           # ヒートマップの透明度
 
         # レコード関連
         self.is_recording = False
-        self.recorded_data = []
+        self.csv_file = None    # 記録中に開いているCSVファイル
+        self.csv_writer = None
         self.frame_counter = 0  # ソフトウェア内のフレーム番号
         self.csv_filename = "recorded_data.csv"
 
-        # グラフ用のデータバッファ
-        self.graph_data_right = []
-        self.graph_data_left = []
-        self.graph_time = []
+        # グラフ用のデータバッファ（長さを固定し、古いデータは追加時に自動で捨てる）
+        self.graph_data_right = deque(maxlen=GRAPH_POINTS)
+        self.graph_data_left = deque(maxlen=GRAPH_POINTS)
+        self.graph_time = deque(maxlen=GRAPH_POINTS)
 
         # アプリケーション開始時刻
         self.start_time = None  # 初期化はapply_settings内で行う
@@ -208,7 +320,7 @@ class GazeApp(QMainWindow):
         # UIのセットアップ
         self.init_ui()
 
-        # スレッド間通信のためのシグナル
+        # スレッド間通信のためのシグナル（新しいフレームが届いたときだけupdate_frameを呼ぶ）
         self.comm = Communicate()
         self.comm.update_image.connect(self.update_frame)
 
@@ -286,12 +398,8 @@ class GazeApp(QMainWindow):
         self.create_menu()
 
     def get_user_list(self):
-        if os.path.exists(self.base_directory):
-            # ユーザーフォルダ名のリストを取得
-            return [name for name in os.listdir(self.base_directory)
-                    if os.path.isdir(os.path.join(self.base_directory, name))]
-        else:
-            return []
+        # ユーザーフォルダ名のリストを取得
+        return list_subdirectories(self.base_directory)
 
     def create_menu(self):
         # メニューバーの作成
@@ -463,10 +571,7 @@ class GazeApp(QMainWindow):
 
     def get_session_list(self):
         if self.current_user:
-            user_directory = os.path.join(self.base_directory, self.current_user)
-            if os.path.exists(user_directory):
-                return [name for name in os.listdir(user_directory)
-                        if os.path.isdir(os.path.join(user_directory, name))]
+            return list_subdirectories(os.path.join(self.base_directory, self.current_user))
         return []
 
     def create_initial_settings_group(self):
@@ -644,7 +749,7 @@ class GazeApp(QMainWindow):
         history_layout = QHBoxLayout()
         self.history_slider = QSlider(Qt.Horizontal)
         self.history_slider.setMinimum(1)
-        self.history_slider.setMaximum(1000)
+        self.history_slider.setMaximum(self.history_capacity)
         self.history_slider.setValue(self.max_history)
         self.history_slider.setTickPosition(QSlider.TicksBelow)
         self.history_slider.setTickInterval(100)
@@ -734,8 +839,8 @@ class GazeApp(QMainWindow):
     def change_history(self, value):
         self.max_history = value
         self.history_value_label.setText(str(value))
-        # gaze_historyの最大長を更新
-        self.gaze_history = deque(self.gaze_history, maxlen=self.max_history)
+        # 履歴が短くなった場合は古い点を捨てる
+        self.gaze_count = min(self.gaze_count, self.max_history)
 
 
     def reset_counts(self):
@@ -754,7 +859,7 @@ class GazeApp(QMainWindow):
             self.image_path_edit.setText(filename)
 
     def apply_settings(self):
-        global camera_matrix, dist_coeffs, ref_image, ref_gray, ref_keypoints, ref_descriptors, orb, flann, map1_frame, map2_frame, roi_frame, new_camera_mtx_frame
+        global camera_matrix, dist_coeffs, ref_image, ref_gray, ref_keypoints, ref_pts, ref_descriptors, orb, matcher, map1_frame, map2_frame, roi_frame, new_camera_mtx_frame
 
         # 基準画像の読み込み
         image_path = self.image_path_edit.text()
@@ -770,8 +875,7 @@ class GazeApp(QMainWindow):
         # カメラ行列の取得
         try:
             camera_matrix_str = self.camera_matrix_text.toPlainText()
-            camera_matrix_values = ast.literal_eval(camera_matrix_str)
-            camera_matrix = np.array(camera_matrix_values, dtype=np.float64)
+            camera_matrix = parse_array_text(camera_matrix_str)
             if camera_matrix.shape != (3, 3):
                 raise ValueError
         except Exception:
@@ -781,8 +885,7 @@ class GazeApp(QMainWindow):
         # 歪み係数の取得
         try:
             dist_coeffs_str = self.dist_coeffs_text.toPlainText()
-            dist_coeffs_values = ast.literal_eval(dist_coeffs_str)
-            dist_coeffs = np.array(dist_coeffs_values, dtype=np.float64)
+            dist_coeffs = parse_array_text(dist_coeffs_str)
             if dist_coeffs.shape[0] != 5:
                 raise ValueError
         except Exception:
@@ -797,30 +900,32 @@ class GazeApp(QMainWindow):
         orb = cv2.ORB_create(nfeatures=300, fastThreshold=7, scaleFactor=1.2,
                              nlevels=8, edgeThreshold=31, patchSize=31)
 
-        # 基準画像の特徴点と記述子を計算
+        # OpenCLが使えれば画像処理をT-APIで行う
+        self.use_opencl = opencl_available()
+
+        # 基準画像の特徴点と記述子を計算（OpenCLが使えればT-APIで計算し、記述子はホストに戻す）
         ref_gray = cv2.cvtColor(ref_image, cv2.COLOR_BGR2GRAY)
-        ref_keypoints, ref_descriptors = orb.detectAndCompute(ref_gray, None)
-
-        # マッチャーの作成（FlannBasedMatcher）
-        FLANN_INDEX_LSH = 6
-        index_params = dict(algorithm=FLANN_INDEX_LSH,
-                            table_number=6,
-                            key_size=12,
-                            multi_probe_level=1)
-        search_params = dict(checks=50)
-        flann = cv2.FlannBasedMatcher(index_params, search_params)
-
-        # フレームの歪み補正マップの事前計算（仮のフレームサイズで計算）
-        # ここでdummy_frameをref_imageと同じサイズにしておく
-        
-        dummy_frame = np.zeros_like(ref_image)
-        map1_frame, map2_frame, roi_frame, new_camera_mtx_frame = precompute_undistort_map((dummy_frame.shape))
+        ref_keypoints, ref_descriptors = orb.detectAndCompute(
+            cv2.UMat(ref_gray) if self.use_opencl else ref_gray, None)
+        if isinstance(ref_descriptors, cv2.UMat):
+            ref_descriptors = ref_descriptors.get()
+        # 特徴点の座標を(N, 2)のfloat32配列として保持し、マッチのインデックスで直接参照する
+        ref_pts = cv2.KeyPoint_convert(ref_keypoints)
+
+        # マッチャーの作成（ハミング距離の総当たり。数百個のORB特徴量ではFLANN-LSHより速い）
+        # 比率テストのためにknnMatch(k=2)を使うのでcrossCheckは無効にする
+        matcher = cv2.BFMatcher(cv2.NORM_HAMMING, crossCheck=False)
+
+        # フレームの歪み補正マップは最初のフレームのサイズで作成する（カメラ行列が変わった可能性があるのでリセット）
+        self.previous_frame_shape = None
+        # 基準画像が変わった可能性があるので再利用するホモグラフィもリセット
+        self.key_thumbnail = None
 
         # ZMQアドレスの取得
         zmq_address = self.zmq_address_edit.text()
 
         # フレーム受信スレッドの開始
-        self.receive_thread = threading.Thread(target=receive_frames, args=(zmq_address,))
+        self.receive_thread = threading.Thread(target=receive_frames, args=(zmq_address, self.comm))
         self.receive_thread.daemon = True
         self.receive_thread.start()
 
@@ -829,16 +934,12 @@ class GazeApp(QMainWindow):
         # サイドバーを閉じることができるようにメニューを有効化
         self.menuBar().setEnabled(True)
 
-        # フレーム更新用のタイマー
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update_frame)
-        self.timer.start(16)  # 約33FPSで更新
-
         # アプリケーション開始時刻を設定
         self.start_time = time.time()
 
     def change_point_size(self, value):
         self.gaze_point_size = value
+        self.gaze_sprite = None
         self.size_value_label.setText(str(value))
 
     def change_opacity(self, value):
@@ -855,6 +956,7 @@ class GazeApp(QMainWindow):
             # QColorをBGRのタプルに変換
             self.gaze_point_color = (
                 color.blue(), color.green(), color.red())
+            self.gaze_sprite = None
 
     def toggle_fps(self, state):
         self.show_fps = state == Qt.Checked
@@ -900,30 +1002,36 @@ class GazeApp(QMainWindow):
             except Exception as e:
                 QMessageBox.warning(self, self.tr("エラー"), f"{self.tr('AOIの読み込み中にエラーが発生しました:')} {e}")
 
+    def update_aoi_bboxes(self):
+        # AOIリストが変わった時だけ矩形の配列を作り直す
+        if self.aoi_bbox_owners != self.aoi_list:
+            self.aoi_bbox_owners = list(self.aoi_list)
+            self.aoi_bboxes = np.array(
+                [(aoi.rect.left(), aoi.rect.top(), aoi.rect.right(), aoi.rect.bottom())
+                 for aoi in self.aoi_list], dtype=np.float64).reshape(-1, 4)
+            # polylines用の四隅の座標 (N, 4, 2)
+            self.aoi_corners = self.aoi_bboxes.astype(np.int32)[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+        return self.aoi_bboxes
+
+    def aoi_at(self, x, y):
+        # 座標を含むAOIのうち最前面（最後に追加されたもの）を返す、なければNone
+        bboxes = self.update_aoi_bboxes()
+        hits = np.flatnonzero((bboxes[:, 0] <= x) & (x <= bboxes[:, 2]) &
+                              (bboxes[:, 1] <= y) & (y <= bboxes[:, 3]))
+        return self.aoi_list[hits[-1]] if len(hits) else None
+
     def image_mouse_press_event(self, event):
         if event.button() == Qt.LeftButton and self.is_configured:
             # クリック位置を基準画像の座標に変換
             pos = event.pos()
-            pixmap = self.image_label.pixmap()
-            if pixmap:
-                label_rect = self.image_label.contentsRect()
-                label_width = label_rect.width()
-                label_height = label_rect.height()
-                pixmap_width = pixmap.width()
-                pixmap_height = pixmap.height()
-                scaled_w = pixmap_width * min(label_width / pixmap_width, label_height / pixmap_height)
-                scaled_h = pixmap_height * min(label_width / pixmap_width, label_height / pixmap_height)
-                offset_x = (label_width - scaled_w) / 2
-                offset_y = (label_height - scaled_h) / 2
-                scale_x = pixmap_width / scaled_w
-                scale_y = pixmap_height / scaled_h
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
                 x = (pos.x() - offset_x) * scale_x
                 y = (pos.y() - offset_y) * scale_y
-                # クリック位置が既存のAOI内にあるかチェック
-                for aoi in reversed(self.aoi_list):
-                    if aoi.rect.contains(QPointF(x, y)):
-                        # 既存のAOI内をクリックした場合、新しいAOIの作成を開始しない
-                        return
+                # 既存のAOI内をクリックした場合、新しいAOIの作成を開始しない
+                if self.aoi_at(x, y) is not None:
+                    return
             # 新しいAOIの作成を開始
             self.drawing_aoi = True
             self.aoi_start_point = event.pos()
@@ -941,20 +1049,9 @@ class GazeApp(QMainWindow):
             start = self.aoi_start_point
             end = self.aoi_end_point
             # 座標を基準画像のスケールに合わせる
-            pixmap = self.image_label.pixmap()
-            if pixmap:
-                label_rect = self.image_label.contentsRect()
-                label_width = label_rect.width()
-                label_height = label_rect.height()
-                pixmap_width = pixmap.width()
-                pixmap_height = pixmap.height()
-                # 画像がラベル内でどのように配置されているかを計算
-                scaled_w = pixmap_width * min(label_width / pixmap_width, label_height / pixmap_height)
-                scaled_h = pixmap_height * min(label_width / pixmap_width, label_height / pixmap_height)
-                offset_x = (label_width - scaled_w) / 2
-                offset_y = (label_height - scaled_h) / 2
-                scale_x = pixmap_width / scaled_w
-                scale_y = pixmap_height / scaled_h
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
                 start_x = (start.x() - offset_x) * scale_x
                 start_y = (start.y() - offset_y) * scale_y
                 end_x = (end.x() - offset_x) * scale_x
@@ -968,29 +1065,17 @@ class GazeApp(QMainWindow):
         if self.is_configured:
             # クリック位置を基準画像の座標に変換
             pos = event.pos()
-            pixmap = self.image_label.pixmap()
-            if pixmap:
-                label_rect = self.image_label.contentsRect()
-                label_width = label_rect.width()
-                label_height = label_rect.height()
-                pixmap_width = pixmap.width()
-                pixmap_height = pixmap.height()
-                scaled_w = pixmap_width * min(label_width / pixmap_width, label_height / pixmap_height)
-                scaled_h = pixmap_height * min(label_width / pixmap_width, label_height / pixmap_height)
-                offset_x = (label_width - scaled_w) / 2
-                offset_y = (label_height - scaled_h) / 2
-                scale_x = pixmap_width / scaled_w
-                scale_y = pixmap_height / scaled_h
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
                 x = (pos.x() - offset_x) * scale_x
                 y = (pos.y() - offset_y) * scale_y
-                # AOIのリストを逆順にチェック（最後に追加されたものが最前面）
-                for aoi in reversed(self.aoi_list):
-                    if aoi.rect.contains(QPointF(x, y)):
-                        # 名前を変更するダイアログを表示
-                        text, ok = QInputDialog.getText(self, self.tr('AOIの名前を設定'), self.tr('AOIの名前:'), text=aoi.name)
-                        if ok:
-                            aoi.name = text
-                        break
+                # 最前面のAOIの名前を変更するダイアログを表示
+                aoi = self.aoi_at(x, y)
+                if aoi is not None:
+                    text, ok = QInputDialog.getText(self, self.tr('AOIの名前を設定'), self.tr('AOIの名前:'), text=aoi.name)
+                    if ok:
+                        aoi.name = text
 
     def contextMenuEvent(self, event):
         if not self.is_configured:
@@ -999,44 +1084,31 @@ class GazeApp(QMainWindow):
         if self.image_label.geometry().contains(pos):
             # クリック位置を画像上の座標に変換
             img_pos = self.image_label.mapFromParent(pos)
-            pixmap = self.image_label.pixmap()
-            if pixmap:
-                label_rect = self.image_label.contentsRect()
-                label_width = label_rect.width()
-                label_height = label_rect.height()
-                pixmap_width = pixmap.width()
-                pixmap_height = pixmap.height()
-                scaled_w = pixmap_width * min(label_width / pixmap_width, label_height / pixmap_height)
-                scaled_h = pixmap_height * min(label_width / pixmap_width, label_height / pixmap_height)
-                offset_x = (label_width - scaled_w) / 2
-                offset_y = (label_height - scaled_h) / 2
-                scale_x = pixmap_width / scaled_w
-                scale_y = pixmap_height / scaled_h
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
                 x = (img_pos.x() - offset_x) * scale_x
                 y = (img_pos.y() - offset_y) * scale_y
                 # クリック位置がAOI内かチェック
-                for aoi in reversed(self.aoi_list):
-                    if aoi.rect.contains(QPointF(x, y)):
-                        # コンテキストメニューの作成
-                        menu = QMenu(self)
-                        rename_action = menu.addAction(self.tr('AOIの名前を変更'))
-                        delete_action = menu.addAction(self.tr('AOIを削除'))
-                        action = menu.exec_(self.mapToGlobal(pos))
-                        if action == rename_action:
-                            text, ok = QInputDialog.getText(self, self.tr('AOIの名前を設定'), self.tr('AOIの名前:'), text=aoi.name)
-                            if ok:
-                                aoi.name = text
-                        elif action == delete_action:
-                            self.aoi_list.remove(aoi)
-                            self.update_frame()
-                        break
+                aoi = self.aoi_at(x, y)
+                if aoi is not None:
+                    # コンテキストメニューの作成
+                    menu = QMenu(self)
+                    rename_action = menu.addAction(self.tr('AOIの名前を変更'))
+                    delete_action = menu.addAction(self.tr('AOIを削除'))
+                    action = menu.exec_(self.mapToGlobal(pos))
+                    if action == rename_action:
+                        text, ok = QInputDialog.getText(self, self.tr('AOIの名前を設定'), self.tr('AOIの名前:'), text=aoi.name)
+                        if ok:
+                            aoi.name = text
+                    elif action == delete_action:
+                        self.aoi_list.remove(aoi)
+                        self.update_frame()
 
     def start_recording(self):
         if not self.current_session:
             QMessageBox.warning(self, self.tr("エラー"), self.tr("セッションを開始してください。"))
             return
-        self.is_recording = True
-        self.recorded_data = []
         self.frame_counter = 0
 
         # 保存先ディレクトリの設定
@@ -1052,6 +1124,16 @@ class GazeApp(QMainWindow):
             index += 1
         self.csv_filename = csv_filename
 
+        # 記録中は1行ずつ書き込む（64KBのバッファにまとめて書き出すので、停止時にまとめて書く必要がない）
+        try:
+            self.csv_file = open(self.csv_filename, 'w', newline='', encoding='utf-8', buffering=1 << 16)
+            self.csv_writer = csv.writer(self.csv_file)
+            self.csv_writer.writerow(CSV_FIELDNAMES)
+        except OSError as e:
+            QMessageBox.warning(self, self.tr("エラー"), f"{self.tr('データの保存中にエラーが発生しました:')} {e}")
+            return
+        self.is_recording = True
+
         self.csv_filename_edit.setEnabled(False)
         # ボタンの有効・無効を切り替え
         self.record_start_button.setEnabled(False)
@@ -1059,23 +1141,25 @@ class GazeApp(QMainWindow):
         
     def stop_recording(self):
         self.is_recording = False
-        # CSVファイルにデータを保存
-        try:
-            with open(self.csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-                fieldnames = ['Frame', 'PicNum', 'GazeX', 'GazeY', 'AOI', 'ScoreRight', 'ScoreLeft', 'SystemTime']
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for data in self.recorded_data:
-                    writer.writerow(data)
-            QMessageBox.information(self, self.tr("保存完了"), f"{self.csv_filename} {self.tr('にデータを保存しました。')}")
-        except Exception as e:
-            QMessageBox.warning(self, self.tr("エラー"), f"{self.tr('データの保存中にエラーが発生しました:')} {e}")
+        csv_file = self.csv_file
+        self.csv_file = None
+        self.csv_writer = None
 
         self.csv_filename_edit.setEnabled(True)
         # ボタンの有効・無効を切り替え
         self.record_start_button.setEnabled(True)
         self.record_stop_button.setEnabled(False)
 
+        # 記録していなければ（セッション終了時など）保存するファイルはない
+        if csv_file is None:
+            return
+        # 残りのデータを書き出してCSVファイルを閉じる
+        try:
+            csv_file.close()
+            QMessageBox.information(self, self.tr("保存完了"), f"{self.csv_filename} {self.tr('にデータを保存しました。')}")
+        except Exception as e:
+            QMessageBox.warning(self, self.tr("エラー"), f"{self.tr('データの保存中にエラーが発生しました:')} {e}")
+
 
     def update_statistics(self):
         # 統計情報レイアウトをクリア
@@ -1099,6 +1183,58 @@ class GazeApp(QMainWindow):
             label = QLabel(label_text)
             self.statistics_layout.addWidget(label)
 
+    def compute_homography(self, frame_gray, undistort_keypoints=False):
+        # フレームの特徴点と記述子を計算し、基準画像へのホモグラフィ行列を返す（計算できない場合はNone）
+        # 特徴点は1/2に縮小した画像で検出する（FASTの判定画素数が1/4になる）
+        frame_small = cv2.pyrDown(frame_gray)
+        frame_keypoints, frame_descriptors = orb.detectAndCompute(frame_small, None)
+        if isinstance(frame_descriptors, cv2.UMat):
+            frame_descriptors = frame_descriptors.get()
+        if frame_descriptors is None or len(frame_descriptors) == 0:
+            return None
+
+        # マッチングを実行
+        matches = matcher.knnMatch(ref_descriptors, frame_descriptors, k=2)
+
+        # 比率テストをまとめて適用（列: 最良の距離, 2番目の距離, queryIdx, trainIdx）
+        match_data = np.array([(m_n[0].distance, m_n[1].distance, m_n[0].queryIdx, m_n[0].trainIdx)
+                               for m_n in matches if len(m_n) == 2], dtype=np.float32).reshape(-1, 4)
+        good_matches = match_data[match_data[:, 0] < 0.75 * match_data[:, 1]]
+        if len(good_matches) <= 10:
+            return None
+
+        query_idx = good_matches[:, 2].astype(np.intp)
+        train_idx = good_matches[:, 3].astype(np.intp)
+        src_pts = ref_pts[query_idx].reshape(-1, 1, 2)
+        # 縮小画像の座標を元の解像度に戻す（ホモグラフィをS·M·S⁻¹で補正するのと同じ）
+        dst_pts = cv2.KeyPoint_convert(frame_keypoints)[train_idx].reshape(-1, 1, 2) * 2
+        if undistort_keypoints:
+            # 歪んだフレームの特徴点をクロップ後の歪み補正済みフレームの座標に移す
+            dst_pts = cv2.undistortPoints(dst_pts, camera_matrix, dist_coeffs, P=self.crop_projection)
+
+        # ホモグラフィ行列の計算（計算できなければNone）。古いOpenCVではRANSACを使う
+        if USE_MAGSAC:
+            M, mask = cv2.findHomography(dst_pts, src_pts, cv2.USAC_MAGSAC, 3.0, maxIters=500, confidence=0.99)
+        else:
+            M, mask = cv2.findHomography(dst_pts, src_pts, cv2.RANSAC, 5.0)
+        return M
+
+    def build_gaze_sprite(self):
+        # 視線ポイントの円を(2r+1)x(2r+1)の色のタイルと円の内側のマスクとして一度だけ描く
+        r = self.gaze_point_size
+        sprite = np.empty((2 * r + 1, 2 * r + 1, 3), dtype=np.uint8)
+        sprite[:] = self.gaze_point_color
+        sprite_mask = np.zeros((2 * r + 1, 2 * r + 1), dtype=np.uint8)
+        cv2.circle(sprite_mask, (r, r), r, 255, -1)
+        return sprite, sprite_mask.astype(bool)
+
+    def recent_gaze_points(self):
+        # リングバッファの最新gaze_count個の点を(N, 2)の配列として返す
+        start = self.gaze_head - self.gaze_count
+        if start >= 0:
+            return self.gaze_history[start:self.gaze_head]
+        return np.concatenate((self.gaze_history[start:], self.gaze_history[:self.gaze_head]))
+
     def update_frame(self, draw_aoi_preview=False):
         if not self.is_configured:
             return
@@ -1119,11 +1255,18 @@ class GazeApp(QMainWindow):
             if frame_proc is None:
                 return
 
-            # フレームサイズが変わった可能性があるので、歪み補正マップを再計算
+            # フレームサイズが変わったときだけ歪み補正マップを取得（一度作成したサイズはキャッシュから）
             global map1_frame, map2_frame, roi_frame, new_camera_mtx_frame
-            # map1_frame, map2_frame, roi_frame, new_camera_mtx_frame = precompute_undistort_map(frame_proc.shape)
             if self.previous_frame_shape != frame_proc.shape[:2]:
                 map1_frame, map2_frame, roi_frame, new_camera_mtx_frame = precompute_undistort_map(frame_proc.shape)
+                if self.use_opencl and map1_frame is not None:
+                    # 固定小数点のマップはOpenCLデバイスに置いたままにし、remapのたびに転送しない
+                    map1_frame, map2_frame = cv2.UMat(map1_frame), cv2.UMat(map2_frame)
+                self.undistort_buffer = np.empty((roi_frame[3], roi_frame[2]) + frame_proc.shape[2:], np.uint8)
+                # 正規化カメラ座標からクロップ後のフレームの画素座標への変換
+                crop_x, crop_y = roi_frame[:2]
+                self.crop_projection = np.array(
+                    [[1, 0, -crop_x], [0, 1, -crop_y], [0, 0, 1]], np.float64) @ new_camera_mtx_frame
                 self.previous_frame_shape = frame_proc.shape[:2]
 
             # 視線座標を画像サイズにスケーリング
@@ -1131,243 +1274,297 @@ class GazeApp(QMainWindow):
             gaze_x = gaze_x * w_frame
             gaze_y = gaze_y * h_frame
 
-            # フレームの歪み補正
-            frame_undistorted = cv2.remap(
-                frame_proc, map1_frame, map2_frame, cv2.INTER_LINEAR)
-            x, y, w, h = roi_frame
-            frame_undistorted = frame_undistorted[y:y+h, x:x+w]
+            # フレーム全体の歪み補正はシーンカメラのオーバーレイを表示するときだけ行う。
+            # それ以外は歪んだままのフレームで特徴点を検出し、マッチした特徴点の座標だけを歪み補正する
+            # （どちらの場合もホモグラフィはクロップ後の歪み補正済みフレームから基準画像への変換になる。
+            # マップはroiの部分だけなので、remapの結果がそのままクロップ後のフレームになる）
+            if self.overlay_scene:
+                # フレームの歪み補正（CV_16SC2の座標マップと補間テーブルの両方を渡して固定小数点の経路を使う）
+                if map1_frame is None:
+                    # 歪みのないカメラではフレームがそのまま歪み補正済みのフレームになる
+                    frame_undistorted = cv2.UMat(frame_proc) if self.use_opencl else frame_proc
+                elif self.use_opencl:
+                    # 歪み補正・グレースケール変換・特徴点検出・シーンの変換をOpenCLデバイス上で行う
+                    frame_undistorted = cv2.remap(cv2.UMat(frame_proc), map1_frame, map2_frame, cv2.INTER_LINEAR)
+                else:
+                    frame_undistorted = cv2.remap(
+                        frame_proc, map1_frame, map2_frame, cv2.INTER_LINEAR, dst=self.undistort_buffer)
+                frame_source = frame_undistorted
+                undistort_keypoints = False
+            else:
+                frame_source = cv2.UMat(frame_proc) if self.use_opencl else frame_proc
+                undistort_keypoints = True
 
-            # 視線座標の歪み補正
-            gaze_point = np.array([[gaze_x, gaze_y]], dtype=np.float32).reshape(-1, 1, 2)
-            gaze_point_undistorted = cv2.undistortPoints(
-                gaze_point, camera_matrix, dist_coeffs, P=new_camera_mtx_frame)
-            gaze_x_ud, gaze_y_ud = gaze_point_undistorted[0][0]
-            gaze_x_ud -= x  # クロップした分を調整
-            gaze_y_ud -= y  # クロップした分を調整
+            # 視線座標の歪み補正（正規化カメラ座標まで。画素座標への投影はホモグラフィと合わせて行う）
+            gaze_point = np.array([[[gaze_x, gaze_y]]], dtype=np.float32)
+            gaze_x_n, gaze_y_n = cv2.undistortPoints(gaze_point, camera_matrix, dist_coeffs)[0, 0]
 
             # グレースケール変換
-            frame_gray = cv2.cvtColor(frame_undistorted, cv2.COLOR_BGR2GRAY)
-
-            # フレームの特徴点と記述子を計算
-            frame_keypoints, frame_descriptors = orb.detectAndCompute(frame_gray, None)
-
-            if frame_descriptors is not None and len(frame_descriptors) > 0:
-                # マッチングを実行
-                matches = flann.knnMatch(ref_descriptors, frame_descriptors, k=2)
-
-                # 比率テストを適用
-                good_matches = []
-                for m_n in matches:
-                    if len(m_n) == 2:
-                        m, n = m_n
-                        if m.distance < 0.75 * n.distance:
-                            good_matches.append(m)
-
-                if len(good_matches) > 10:
-                    src_pts = np.float32(
-                        [ref_keypoints[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-                    dst_pts = np.float32(
-                        [frame_keypoints[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-
-                    # ホモグラフィ行列の計算
-                    M, mask = cv2.findHomography(dst_pts, src_pts, cv2.RANSAC, 5.0)
-
-                    # 視線位置を基準画像の座標系に変換
-                    if M is not None:
-                        gaze_point_ref = cv2.perspectiveTransform(
-                            np.array([[[gaze_x_ud, gaze_y_ud]]], dtype=np.float32), M)
-                        x_ref, y_ref = gaze_point_ref[0][0]
-
-                        # 視線データを履歴に追加
-                        self.gaze_history.append((int(x_ref), int(y_ref)))
-                        if len(self.gaze_history) > self.max_history:
-                            self.gaze_history.pop(0)
-
-                        # 基準画像上に視線位置を描画
-                        ref_image_display = ref_image.copy()
-
-                        # シーンカメラのオーバーレイが有効な場合
-                        if self.overlay_scene:
-                            # シーンカメラのフレームを基準画像の座標系に変換
-                            h_ref, w_ref = ref_image.shape[:2]
-                            warped_scene = cv2.warpPerspective(frame_undistorted, M, (w_ref, h_ref))
-                            # シーンカメラの透明度を適用
-                            cv2.addWeighted(warped_scene, self.scene_opacity,
-                                            ref_image_display, 1 - self.scene_opacity, 0, ref_image_display)
-
-                        # ヒートマップの作成と適用
-                        if self.heatmap_checkbox.isChecked() and len(self.gaze_history) > 0:
-                            heatmap = np.zeros((ref_image.shape[0], ref_image.shape[1]), dtype=np.float32)
-                            for point in self.gaze_history:
-                                cv2.circle(heatmap, point, self.gaze_point_size, 1, -1)
-                            heatmap = cv2.GaussianBlur(heatmap, (0, 0), sigmaX=15, sigmaY=15)
-                            heatmap = cv2.normalize(heatmap, None, 0, 255, cv2.NORM_MINMAX)
-                            heatmap_color = cv2.applyColorMap(heatmap.astype(np.uint8), cv2.COLORMAP_JET)
-
-                            # 強度に基づいたアルファマスクを作成
-                            alpha_mask = heatmap / 255.0 * self.heatmap_opacity
-                            alpha_mask = cv2.merge([alpha_mask, alpha_mask, alpha_mask])
-
-                            # ヒートマップを適用
-                            ref_image_display = ref_image_display.astype(np.float32) / 255.0
-                            heatmap_color = heatmap_color.astype(np.float32) / 255.0
-                            ref_image_display = (1 - alpha_mask) * ref_image_display + alpha_mask * heatmap_color
-                            ref_image_display = (ref_image_display * 255).astype(np.uint8)
-
-                        # 視線ポイントの透明度を適用
-                        overlay = ref_image_display.copy()
-                        color = (*self.gaze_point_color,)
-                        cv2.circle(overlay, (int(x_ref), int(y_ref)),
-                                   self.gaze_point_size, color, -1)
-                        cv2.addWeighted(overlay, self.gaze_point_opacity,
-                                        ref_image_display, 1 - self.gaze_point_opacity, 0, ref_image_display)
-
-                        # 現在のsystem_timeを保持
-                        self.current_system_time = self.parse_system_time(system_time_str)
-
-                        # AOIの処理
-                        gaze_aoi_name = ''
-                        for aoi in self.aoi_list:
-                            # AOIの矩形を取得
-                            rect = aoi.rect
-                            # 視線がAOI内にあるかチェック
-                            gaze_inside = rect.contains(QPointF(x_ref, y_ref))
-
-                            if gaze_inside:
-                                if not aoi.is_gaze_inside:
-                                    # 視線がAOIに入った
-                                    aoi.hit_count += 1
-                                    aoi.entry_time = self.current_system_time
-                                aoi.is_gaze_inside = True
-                                gaze_aoi_name = aoi.name
-                            else:
-                                if aoi.is_gaze_inside:
-                                    # 視線がAOIから出た
-                                    if aoi.entry_time is not None:
-                                        aoi.dwell_time += self.current_system_time - aoi.entry_time
-                                        aoi.entry_time = None
-                                aoi.is_gaze_inside = False
-
-                            # AOIの描画
-                            rect_top_left = (int(rect.left()), int(rect.top()))
-                            rect_bottom_right = (int(rect.right()), int(rect.bottom()))
-                            if aoi.is_gaze_inside:
-                                # 視線が内側にある場合の色（例：赤）
-                                rect_color = (0, 0, 255)
-                            else:
-                                # デフォルトの色（例：緑）
-                                rect_color = (0, 255, 0)
-                            cv2.rectangle(ref_image_display, rect_top_left, rect_bottom_right, rect_color, 1)
-
-                            # ヒットカウントまたは名前をAOIの上に表示
-                            if aoi.name:
-                                display_text = f'{aoi.name}: {aoi.hit_count}'
-                            else:
-                                display_text = f'{self.tr("無名")}: {aoi.hit_count}'
-                            text_size, baseline = cv2.getTextSize(display_text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)
-                            text_x = rect_top_left[0]
-                            text_y = rect_top_left[1] - 5
-                            if text_y < 0:
-                                text_y = rect_bottom_right[1] + text_size[1] + 5
-                            cv2.putText(ref_image_display, display_text, (text_x, text_y),
-                                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, rect_color, 1)
-
-                        # 統計情報の更新
-                        self.update_statistics()
-
-                        # AOIを描画中の場合、プレビューを表示
-                        # if self.drawing_aoi and draw_aoi_preview:
-                                                        # AOIを描画中の場合、プレビューを表示
-                        if self.drawing_aoi and draw_aoi_preview:
-                            start = self.aoi_start_point
-                            end = self.aoi_end_point
-                            # 座標を基準画像のスケールに合わせる
-                            pixmap = self.image_label.pixmap()
-                            if pixmap:
-                                label_rect = self.image_label.contentsRect()
-                                label_width = label_rect.width()
-                                label_height = label_rect.height()
-                                pixmap_width = pixmap.width()
-                                pixmap_height = pixmap.height()
-                                # 画像がラベル内でどのように配置されているかを計算
-                                scaled_w = pixmap_width * min(
-                                    label_width / pixmap_width, label_height / pixmap_height)
-                                scaled_h = pixmap_height * min(
-                                    label_width / pixmap_width, label_height / pixmap_height)
-                                offset_x = (label_width - scaled_w) / 2
-                                offset_y = (label_height - scaled_h) / 2
-                                scale_x = pixmap_width / scaled_w
-                                scale_y = pixmap_height / scaled_h
-                                start_x = (start.x() - offset_x) * scale_x
-                                start_y = (start.y() - offset_y) * scale_y
-                                end_x = (end.x() - offset_x) * scale_x
-                                end_y = (end.y() - offset_y) * scale_y
-                                cv2.rectangle(ref_image_display, (int(start_x), int(start_y)),
-                                                (int(end_x), int(end_y)), (255, 0, 0), 1)
-
-                        # FPSの計算
-                        current_time = time.time()
-                        self.fps = 1 / (current_time - self.previous_time)
-                        self.previous_time = current_time
-
-                        # FPSを表示する場合
-                        if self.show_fps:
-                            fps_text = f"FPS: {self.fps:.2f}"
-                            cv2.putText(ref_image_display, fps_text, (10, 30),
-                                        cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-
-                        # 画像をQt形式に変換して表示
-                        self.display_image(ref_image_display)
-                        current_time = self.current_system_time
-                        self.graph_time.append(current_time)
-                        self.graph_data_right.append(score_right)
-                        self.graph_data_left.append(score_left)
-
-                        # バッファのサイズを制限
-                        max_points = 100  # 表示する最大ポイント数
-                        if len(self.graph_time) > max_points:
-                            self.graph_time = self.graph_time[-max_points:]
-                            self.graph_data_right = self.graph_data_right[-max_points:]
-                            self.graph_data_left = self.graph_data_left[-max_points:]
-
-                        # グラフのプロットを更新
-                        self.score_right_line.setData(self.graph_time, self.graph_data_right)
-                        self.score_left_line.setData(self.graph_time, self.graph_data_left)
-
-                        # レコード中の場合、データを記録
-                        if self.is_recording:
-                            self.frame_counter += 1
-                            data = {
-                                'Frame': self.frame_counter,
-                                'PicNum': pic_num,
-                                'GazeX': x_ref,
-                                'GazeY': y_ref,
-                                'AOI': gaze_aoi_name,
-                                'ScoreRight': score_right,
-                                'ScoreLeft': score_left,
-                                'SystemTime': system_time_str
-                            }
-                            self.recorded_data.append(data)
+            frame_gray = cv2.cvtColor(frame_source, cv2.COLOR_BGR2GRAY)
+
+            # ホモグラフィを計算したフレームからシーンがほとんど動いていなければ（縮小画像の画素あたりの
+            # 平均絶対差が閾値未満なら）特徴点検出からホモグラフィ計算までを省略して前回の行列を使う。
+            # 誤差が残り続けないよう、一定フレーム数ごとに計算し直す
+            thumbnail = cv2.resize(frame_gray, (64, 64), interpolation=cv2.INTER_AREA)
+            if self.use_opencl:
+                thumbnail = thumbnail.get()
+            if self.key_thumbnail is not None and self.homography_reuse_count < HOMOGRAPHY_REFRESH_FRAMES and \
+                    cv2.norm(thumbnail, self.key_thumbnail, cv2.NORM_L1) < MOTION_THRESHOLD * thumbnail.size:
+                M = self.last_homography
+                self.homography_reuse_count += 1
+            else:
+                M = self.compute_homography(frame_gray, undistort_keypoints)
+                self.key_thumbnail = thumbnail if M is not None else None
+                self.last_homography = M
+                self.homography_reuse_count = 0
+
+            # 視線位置を基準画像の座標系に変換
+            if M is not None:
+                # （新しいカメラ行列・クロップ・ホモグラフィを3x3の積1回で適用）
+                gaze_point_ref = M @ self.crop_projection @ (gaze_x_n, gaze_y_n, 1.0)
+                x_ref, y_ref = (gaze_point_ref[:2] / gaze_point_ref[2]).astype(np.float32)
+
+                # 視線データを履歴に追加
+                # （リングバッファに上書きするので古い点は自動的に捨てられる）
+                self.gaze_history[self.gaze_head] = (int(x_ref), int(y_ref))
+                self.gaze_head = (self.gaze_head + 1) % self.history_capacity
+                self.gaze_count = min(self.gaze_count + 1, self.max_history)
+
+                # 基準画像上に視線位置を描画（表示画像は毎フレーム確保せずバッファに書き込む）
+                if self.display_buffer is None or self.display_buffer.shape != ref_image.shape:
+                    self.display_buffer = np.empty_like(ref_image)
+                ref_image_display = self.display_buffer
+
+                # シーンカメラのオーバーレイが有効な場合
+                if self.overlay_scene:
+                    # シーンカメラのフレームを基準画像の座標系に変換（CPUでは再利用バッファに書き込む）
+                    h_ref, w_ref = ref_image.shape[:2]
+                    if self.use_opencl:
+                        warped_scene = cv2.warpPerspective(frame_undistorted, M, (w_ref, h_ref)).get()
+                    else:
+                        if self.warp_buffer is None or self.warp_buffer.shape != ref_image.shape:
+                            self.warp_buffer = np.empty_like(ref_image)
+                        warped_scene = cv2.warpPerspective(frame_undistorted, M, (w_ref, h_ref), dst=self.warp_buffer)
+                    # シーンカメラの透明度を適用（基準画像と合成した結果を表示バッファに直接書き込む）
+                    cv2.addWeighted(warped_scene, self.scene_opacity,
+                                    ref_image, 1 - self.scene_opacity, 0, ref_image_display)
+                else:
+                    np.copyto(ref_image_display, ref_image)
+
+                # ヒートマップの作成と適用
+                if self.heatmap_checkbox.isChecked() and self.gaze_count > 0:
+                    # ぼかした後のヒートマップは、どの視線ポイントからも円の半径とカーネルの半径を
+                    # 足した距離より離れた所では0なので、その外接矩形の範囲だけを描画・ぼかし・合成する
+                    h_ref, w_ref = ref_image.shape[:2]
+                    r = self.gaze_point_size
+                    points = self.recent_gaze_points()
+                    points = points[(points[:, 0] >= -r) & (points[:, 0] < w_ref + r) &
+                                    (points[:, 1] >= -r) & (points[:, 1] < h_ref + r)]
+                    if len(points) > 0:
+                        pad = r + HEATMAP_KERNEL_RADIUS
+                        x0 = max(0, int(points[:, 0].min()) - pad)
+                        y0 = max(0, int(points[:, 1].min()) - pad)
+                        x1 = min(w_ref, int(points[:, 0].max()) + pad + 1)
+                        y1 = min(h_ref, int(points[:, 1].max()) + pad + 1)
+                        roi_w, roi_h = x1 - x0, y1 - y0
+                        # 全ての点の円を一度に描く（中心に印を付けて円形のカーネルで膨張させる。
+                        # 範囲の外に中心がある円も切り取られて残るよう、半径分の余白を付けたキャンバスを使う）
+                        canvas = np.zeros((roi_h + 2 * r, roi_w + 2 * r), dtype=np.uint8)
+                        canvas[points[:, 1] - y0 + r, points[:, 0] - x0 + r] = 255
+                        disk = np.zeros((2 * r + 1, 2 * r + 1), dtype=np.uint8)
+                        cv2.circle(disk, (r, r), r, 1, -1)
+                        canvas = cv2.dilate(canvas, disk)[r:r + roi_h, r:r + roi_w]
+                        # 円の面積を保つよう平均で縮小してからぼかし、なめらかになった結果を線形補間で元の大きさに戻す
+                        small_size = (-(-roi_w // HEATMAP_DOWNSCALE), -(-roi_h // HEATMAP_DOWNSCALE))
+                        small = cv2.resize(canvas, small_size, interpolation=cv2.INTER_AREA).astype(np.float32)
+                        sigma = HEATMAP_SIGMA / HEATMAP_DOWNSCALE
+                        cv2.GaussianBlur(small, (0, 0), sigmaX=sigma, sigmaY=sigma, dst=small)
+                        # 範囲が画像全体でなければ最小値は範囲外の0なので、最大値を255にすれば画像全体の正規化と同じになる
+                        if (roi_h, roi_w) == (h_ref, w_ref):
+                            cv2.normalize(small, small, 0, 255, cv2.NORM_MINMAX)
+                        else:
+                            cv2.normalize(small, small, 255, 0, cv2.NORM_INF)
+                        heatmap = cv2.resize(small, (roi_w, roi_h), interpolation=cv2.INTER_LINEAR)
+                        heatmap_color = cv2.applyColorMap(heatmap.astype(np.uint8), cv2.COLORMAP_JET)
+
+                        # 強度に基づいたアルファマスクを作成（1チャンネルのまま全チャンネルに使う）
+                        alpha_mask = heatmap * (self.heatmap_opacity / 255.0)
+
+                        # ヒートマップを適用（floatの画像に変換せず、uint8の表示画像の範囲に直接1回で合成する）
+                        display_roi = ref_image_display[y0:y1, x0:x1]
+                        cv2.blendLinear(heatmap_color, display_roi, alpha_mask, 1.0 - alpha_mask, dst=display_roi)
+
+                # 視線ポイントの透明度を適用（円の外接矩形の範囲だけを合成する）
+                if self.gaze_sprite is None:
+                    self.gaze_sprite = self.build_gaze_sprite()
+                sprite, sprite_mask = self.gaze_sprite
+                r = self.gaze_point_size
+                cx, cy = int(x_ref), int(y_ref)
+                h_disp, w_disp = ref_image_display.shape[:2]
+                x0, y0 = max(cx - r, 0), max(cy - r, 0)
+                x1, y1 = min(cx + r + 1, w_disp), min(cy + r + 1, h_disp)
+                if x0 < x1 and y0 < y1:
+                    display_roi = ref_image_display[y0:y1, x0:x1]
+                    # 画像内に入るスプライトの部分
+                    sx0, sy0 = x0 - (cx - r), y0 - (cy - r)
+                    covered = sprite_mask[sy0:sy0 + y1 - y0, sx0:sx0 + x1 - x0]
+                    color = sprite[sy0:sy0 + y1 - y0, sx0:sx0 + x1 - x0][covered]
+                    if self.gaze_point_opacity >= 1.0:
+                        display_roi[covered] = color
+                    elif len(color) > 0:
+                        display_roi[covered] = cv2.addWeighted(
+                            color, self.gaze_point_opacity, display_roi[covered], 1 - self.gaze_point_opacity, 0)
+
+                # 現在のsystem_timeを保持
+                self.current_system_time = self.parse_system_time(system_time_str)
+
+                # AOIの処理
+                gaze_aoi_name = ''
+                # AOIの矩形を配列にまとめ、全AOIの内外判定を一度に行う（QRectF.containsと同じく境界を含む）
+                bboxes = self.update_aoi_bboxes()
+                gaze_inside_mask = ((bboxes[:, 0] <= x_ref) & (x_ref <= bboxes[:, 2]) &
+                                    (bboxes[:, 1] <= y_ref) & (y_ref <= bboxes[:, 3]))
+
+                # AOIの枠をまとめて描画（視線が外側のものは緑、内側のものは赤で、それぞれpolylines 1回）
+                cv2.polylines(ref_image_display, self.aoi_corners[~gaze_inside_mask], True, (0, 255, 0), 1)
+                cv2.polylines(ref_image_display, self.aoi_corners[gaze_inside_mask], True, (0, 0, 255), 1)
+
+                for aoi, gaze_inside, bbox in zip(self.aoi_list, gaze_inside_mask.tolist(), bboxes.astype(int).tolist()):
+                    if gaze_inside:
+                        if not aoi.is_gaze_inside:
+                            # 視線がAOIに入った
+                            aoi.hit_count += 1
+                            aoi.entry_time = self.current_system_time
+                        aoi.is_gaze_inside = True
+                        gaze_aoi_name = aoi.name
+                    else:
+                        if aoi.is_gaze_inside:
+                            # 視線がAOIから出た
+                            if aoi.entry_time is not None:
+                                aoi.dwell_time += self.current_system_time - aoi.entry_time
+                                aoi.entry_time = None
+                        aoi.is_gaze_inside = False
+
+                    # AOIのラベルの描画
+                    rect_top_left = (bbox[0], bbox[1])
+                    rect_bottom_right = (bbox[2], bbox[3])
+                    if aoi.is_gaze_inside:
+                        # 視線が内側にある場合の色（例：赤）
+                        rect_color = (0, 0, 255)
+                    else:
+                        # デフォルトの色（例：緑）
+                        rect_color = (0, 255, 0)
+
+                    # ヒットカウントまたは名前をAOIの上に表示
+                    if aoi.name:
+                        display_text = f'{aoi.name}: {aoi.hit_count}'
+                    else:
+                        display_text = f'{self.tr("無名")}: {aoi.hit_count}'
+                    text_size, baseline = cv2.getTextSize(display_text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)
+                    text_x = rect_top_left[0]
+                    text_y = rect_top_left[1] - 5
+                    if text_y < 0:
+                        text_y = rect_bottom_right[1] + text_size[1] + 5
+                    cv2.putText(ref_image_display, display_text, (text_x, text_y),
+                                cv2.FONT_HERSHEY_SIMPLEX, 0.6, rect_color, 1)
+
+                # 統計情報の更新
+                self.update_statistics()
+
+                # AOIを描画中の場合、プレビューを表示
+                # if self.drawing_aoi and draw_aoi_preview:
+                                                # AOIを描画中の場合、プレビューを表示
+                if self.drawing_aoi and draw_aoi_preview:
+                    start = self.aoi_start_point
+                    end = self.aoi_end_point
+                    # 座標を基準画像のスケールに合わせる
+                    mapping = self.label_to_image_mapping()
+                    if mapping:
+                        offset_x, offset_y, scale_x, scale_y = mapping
+                        start_x = (start.x() - offset_x) * scale_x
+                        start_y = (start.y() - offset_y) * scale_y
+                        end_x = (end.x() - offset_x) * scale_x
+                        end_y = (end.y() - offset_y) * scale_y
+                        cv2.rectangle(ref_image_display, (int(start_x), int(start_y)),
+                                        (int(end_x), int(end_y)), (255, 0, 0), 1)
+
+                # FPSの計算
+                current_time = time.time()
+                self.fps = 1 / (current_time - self.previous_time)
+                self.previous_time = current_time
+
+                # FPSを表示する場合
+                if self.show_fps:
+                    fps_text = f"FPS: {self.fps:.2f}"
+                    cv2.putText(ref_image_display, fps_text, (10, 30),
+                                cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+
+                # 画像をQt形式に変換して表示
+                self.display_image(ref_image_display)
+                current_time = self.current_system_time
+                self.graph_time.append(current_time)
+                self.graph_data_right.append(score_right)
+                self.graph_data_left.append(score_left)
+
+                # グラフのプロットを更新（pyqtgraphはdequeを受け取らないので配列にする）
+                graph_time = np.array(self.graph_time)
+                self.score_right_line.setData(graph_time, np.array(self.graph_data_right))
+                self.score_left_line.setData(graph_time, np.array(self.graph_data_left))
+
+                # レコード中の場合、データを記録
+                if self.is_recording:
+                    self.frame_counter += 1
+                    self.csv_writer.writerow((self.frame_counter, pic_num, x_ref, y_ref, gaze_aoi_name,
+                                              score_right, score_left, system_time_str))
 
     def parse_system_time(self, system_time_str):
         # '2024:9:3:13:32:3:585' の形式をパース
         try:
-            parts = system_time_str.split(':')
-            year, month, day, hour, minute, second, millisecond = map(int, parts)
-            dt = datetime.datetime(year, month, day, hour, minute, second, millisecond * 1000)
-            timestamp = dt.timestamp()
-            return timestamp
+            year, month, day, hour, minute, second, millisecond = map(int, system_time_str.split(':'))
+            if not (0 <= minute < 60 and 0 <= second < 60 and 0 <= millisecond < 1000):
+                raise ValueError(system_time_str)
+            return hour_start_timestamp(year, month, day, hour) + minute * 60 + second + millisecond / 1000
         except Exception:
             return time.time()
 
     def display_image(self, img):
-        # BGRからRGBに変換
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        h, w, ch = img_rgb.shape
-        bytes_per_line = ch * w
-        qt_image = QImage(img_rgb.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(qt_image)
+        h, w, ch = img.shape
+        if hasattr(QImage, 'Format_BGR888'):
+            # Qt 5.14以降はBGRをそのまま読み込める
+            if img.strides[1:] != (ch, 1):
+                img = np.ascontiguousarray(img)
+            qt_image = QImage(img.data, w, h, img.strides[0], QImage.Format_BGR888)
+        else:
+            # BGRからRGBに変換（変換先のバッファは再利用する）
+            if self.rgb_buffer is None or self.rgb_buffer.shape != img.shape:
+                self.rgb_buffer = np.empty_like(img)
+            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self.rgb_buffer)
+            qt_image = QImage(self.rgb_buffer.data, w, h, self.rgb_buffer.strides[0], QImage.Format_RGB888)
+        # convertFromImageは画素をコピーするので、numpyのバッファはこの後で再利用してよい。
+        # ラベルは最後に表示したピックスマップを共有しているので、もう一方に書き込んで再確保を避ける
+        pixmap = self.pixmaps[self.pixmap_index]
+        pixmap.convertFromImage(qt_image)
         self.image_label.setPixmap(pixmap)
+        self.pixmap_index = 1 - self.pixmap_index
+
+    def label_to_image_mapping(self):
+        # ラベル内に（縦横比を保って中央に）表示したピックスマップのオフセットと拡大率。
+        # ラベルかピックスマップの大きさが変わったときだけ計算し直す
+        pixmap = self.image_label.pixmap()
+        if not pixmap:
+            return None
+        label_rect = self.image_label.contentsRect()
+        key = (label_rect.width(), label_rect.height(), pixmap.width(), pixmap.height())
+        if key != self.label_mapping_key:
+            label_width, label_height, pixmap_width, pixmap_height = key
+            scale = min(label_width / pixmap_width, label_height / pixmap_height)
+            scaled_w = pixmap_width * scale
+            scaled_h = pixmap_height * scale
+            offset_x = (label_width - scaled_w) / 2
+            offset_y = (label_height - scaled_h) / 2
+            self.label_mapping = (offset_x, offset_y, pixmap_width / scaled_w, pixmap_height / scaled_h)
+            self.label_mapping_key = key
+        return self.label_mapping
 
     def resizeEvent(self, event):
         # ウィンドウサイズが変更されたときにAOIプレビューを更新
@@ -1377,6 +1574,9 @@ class GazeApp(QMainWindow):
 
 # PyQtアプリケーションの実行
 def main():
+    # OpenCVのSIMD最適化を有効にし、スレッド数は物理コア数程度に抑える（GUIと受信のスレッドの分を残す）
+    cv2.setUseOptimized(True)
+    cv2.setNumThreads(max(1, (os.cpu_count() or 2) // 2))
     app = QApplication(sys.argv)
     gaze_app = GazeApp()
     gaze_app.show()
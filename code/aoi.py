@@ -1,26 +1,101 @@
 # aoi.py
 
 """
-This module defines the AOI (Area of Interest) class used to manage areas on the image.
+This module defines the AOI (Area of Interest) class used to manage areas on the image,
+and a grid index to look up the AOIs under a point without testing every AOI.
 
 Classes:
 - AOI: Represents an Area of Interest on the image.
+- AOIIndex: Buckets AOIs into square grid cells of the reference image.
+
+Functions:
+- write_aoi_file(filename, aoi_data): Writes AOI data (list of dicts with 'name' and 'rect') as JSON.
+- read_aoi_file(filename): Reads AOI data written by write_aoi_file.
 
 Data Sent:
 - rect: QRectF defining the area.
 - name: Optional name for the AOI.
+- AOIIndex.query: x, y (point in reference image coordinates).
 
 Data Returned:
 - Keeps track of hit counts, dwell time, and whether gaze is inside the AOI.
+- AOI.bbox, AOI.top_left, AOI.bottom_right: Corners of rect as plain tuples (the latter two as ints for drawing);
+  rect is not modified after the AOI is created.
+- AOIIndex.query: List of AOIs containing the point, in the order they were inserted.
+- read_aoi_file: List of dicts with 'name' and 'rect' ([left, top, width, height]).
+
+AOI files are (de)serialized with orjson when it is installed, otherwise with the json module.
 """
 
+import math
+import json
 from PyQt5.QtCore import QRectF
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 class AOI:
     def __init__(self, rect, name=''):
         self.rect = rect  # QRectF
+        # Corners cached as Python numbers, so per-frame tests and drawing make no Qt calls
+        self.bbox = (rect.left(), rect.top(), rect.right(), rect.bottom())
+        self.top_left = (int(rect.left()), int(rect.top()))
+        self.bottom_right = (int(rect.right()), int(rect.bottom()))
         self.hit_count = 0
         self.dwell_time = 0.0  # Dwell time in seconds
         self.entry_time = None  # Time when gaze entered the AOI (system_time)
         self.is_gaze_inside = False  # Whether the gaze is inside the AOI
         self.name = name  # Name of the AOI
+
+    def contains(self, x, y):
+        left, top, right, bottom = self.bbox
+        return left <= x <= right and top <= y <= bottom
+
+class AOIIndex:
+    def __init__(self, cell_size=64):
+        self.cell_size = cell_size
+        self.cells = {}  # (column, row) -> AOIs overlapping the cell, in insertion order
+
+    def cell_range(self, rect):
+        cs = self.cell_size
+        columns = range(math.floor(rect.left() / cs), math.floor(rect.right() / cs) + 1)
+        rows = range(math.floor(rect.top() / cs), math.floor(rect.bottom() / cs) + 1)
+        return [(column, row) for column in columns for row in rows]
+
+    def insert(self, aoi):
+        for cell in self.cell_range(aoi.rect):
+            self.cells.setdefault(cell, []).append(aoi)
+
+    def remove(self, aoi):
+        for cell in self.cell_range(aoi.rect):
+            bucket = self.cells.get(cell)
+            if bucket and aoi in bucket:
+                bucket.remove(aoi)
+                if not bucket:
+                    del self.cells[cell]
+
+    def clear(self):
+        self.cells.clear()
+
+    def query(self, x, y):
+        bucket = self.cells.get((math.floor(x / self.cell_size), math.floor(y / self.cell_size)))
+        if not bucket:
+            return []
+        return [aoi for aoi in bucket if aoi.contains(x, y)]
+
+def write_aoi_file(filename, aoi_data):
+    if orjson is not None:
+        with open(filename, 'wb') as f:
+            f.write(orjson.dumps(aoi_data, option=orjson.OPT_INDENT_2))
+    else:
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(aoi_data, f, ensure_ascii=False, indent=4)
+
+def read_aoi_file(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
@@ -18,23 +18,50 @@ dist_coeffs = None
 ref_image = None
 ref_gray = None
 ref_keypoints = None
+ref_pts = None
 ref_descriptors = None
 orb = None
-flann = None
-map1_frame = None
-map2_frame = None
-roi_frame = None
-new_camera_mtx_frame = None
-
-# Lock and event for threading
-frame_lock = threading.Lock()
+ref_orb = None  # Detector used only for the reference image, off the processing thread
+# ORB parameters for the reference and frame detectors; small patches and few pyramid
+# levels suit the scene camera resolutions used for gaze mapping
+orb_params = dict(nfeatures=300, fastThreshold=7, scaleFactor=1.4, nlevels=4, edgeThreshold=15, patchSize=15)
+matcher = None
+cross_check_matcher = None
+detection_scale = 0.5  # Scale (relative to the sent frame) ORB keypoints are detected at (reference stays at full size)
+decode_reduction = 1  # Decode encoded frames at 1/1, 1/2, 1/4 or 1/8 of their size (1, 2, 4, 8)
+motion_threshold = 1.0  # Mean absolute thumbnail difference below which the last homography is reused
+track_refresh_frames = 10  # Frames the homography is tracked with optical flow before ORB matching runs again (0: always ORB)
+remap_frames = False  # Undistort whole frames before feature detection instead of only the matched keypoints (strong lens distortion)
+cross_check = False  # Keep mutual nearest neighbours (one match pass) instead of the 2-NN ratio test (CPU only)
+
+# CUDA image pipeline (used only when a CUDA device is available)
+use_cuda = False
+cuda_stream = None
+cuda_orb = None
+cuda_matcher = None
+ref_descriptors_gpu = None
+ref_image_gpu = None
+frame_gpu = None
+frame_pinned = None  # Page-locked host copy of the frame the uploads are made from
+undistorted_gpu = None
+warped_gpu = None
+blended_gpu = None
+map1_gpu = None
+map2_gpu = None
+
+# OpenCL (T-API) image pipeline through cv2.UMat, used when CUDA is not available
+use_opencl = False
+
+# Latest received frame as a single tuple (frame, gaze_x, gaze_y, frame_num, score_right,
+# score_left, system_time, timestamp, frame_scale); timestamp is system_time in seconds since the
+# epoch. The receiver replaces the whole tuple, which is an
+# atomic reference store, so readers need no lock; frame_available wakes the processing thread.
+latest_frame = [None]
 frame_available = threading.Event()
-shared_data = {
-    'frame': None,
-    'gaze_x': None,
-    'gaze_y': None,
-    'frame_num': None,
-    'score_right': None,
-    'score_left': None,
-    'system_time': None
-}
+
+# Scene overlay settings read by the processing thread
+overlay_settings = {'overlay_scene': False, 'scene_opacity': 0.5}
+
+# Set by the GUI once it has copied the last processed image, so the processing
+# thread may reuse that output buffer
+result_consumed = threading.Event()
@@ -19,6 +19,8 @@ import datetime
 
 class Communicate(QObject):
     update_image = pyqtSignal()
+    frame_processed = pyqtSignal(object)
+    reference_loaded = pyqtSignal(object)
 
 class CollapsibleBox(QWidget):
     def __init__(self, title="", parent=None):
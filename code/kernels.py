@@ -0,0 +1,41 @@
+# kernels.py
+
+"""
+This module contains per-pixel image kernels. They are compiled with Numba when it is installed
+and fall back to equivalent OpenCV calls otherwise.
+
+Functions:
+- blend_images(fg, bg, alpha, out): Writes alpha * fg + (1 - alpha) * bg into out.
+
+Data Sent:
+- fg, bg: uint8 images of the same shape.
+- alpha: Weight of fg (0.0 - 1.0).
+- out: uint8 output image of the same shape.
+
+Data Returned:
+- out, holding the blended image.
+"""
+
+import cv2
+
+try:
+    from numba import njit, prange
+    NUMBA_AVAILABLE = True
+except ImportError:
+    NUMBA_AVAILABLE = False
+
+if NUMBA_AVAILABLE:
+    @njit(parallel=True, fastmath=True, cache=True)
+    def blend_kernel(fg, bg, alpha, out):
+        h, w, ch = fg.shape
+        beta = 1.0 - alpha
+        for i in prange(h):
+            for j in range(w):
+                for c in range(ch):
+                    out[i, j, c] = int(alpha * fg[i, j, c] + beta * bg[i, j, c] + 0.5)
+
+def blend_images(fg, bg, alpha, out):
+    if NUMBA_AVAILABLE:
+        blend_kernel(fg, bg, alpha, out)
+        return out
+    return cv2.addWeighted(fg, alpha, bg, 1 - alpha, 0, dst=out)
@@ -13,8 +13,10 @@ Data Returned:
 import sys
 from PyQt5.QtWidgets import QApplication
 from main_app import GazeApp
+from utils import configure_opencv
 
 def main():
+    configure_opencv()
     app = QApplication(sys.argv)
     gaze_app = GazeApp()
     gaze_app.show()
@@ -13,7 +13,7 @@ Data Returned:
 - Displays the processed images, graphs, and handles recording and statistics.
 
 Dependencies:
-- Imports functions and classes from utils, receiver, gui_components, aoi, and config modules.
+- Imports functions and classes from utils, receiver, processor, gui_components, aoi, recorder, and config modules.
 """
 
 import sys
@@ -22,27 +22,36 @@ import time
 import threading
 import numpy as np
 import cv2
-import json
-import csv
 import datetime
-from collections import deque
-import ast
 
 from PyQt5.QtWidgets import (QApplication, QMainWindow, QLabel, QVBoxLayout, QWidget,
                              QSlider, QColorDialog, QPushButton, QCheckBox, QHBoxLayout, QSizePolicy,
                              QFileDialog, QLineEdit, QMessageBox, QTextEdit,
                              QSplitter, QAction, QScrollArea, QInputDialog, QMenu, QActionGroup, QComboBox)
 from PyQt5.QtGui import QImage, QPixmap, QColor, QIcon
-from PyQt5.QtCore import Qt, QTimer, QRectF, QPointF, QTranslator
+from PyQt5.QtCore import Qt, QRectF, QPointF, QTranslator, QTimer
 
 import pyqtgraph as pg
 
-from utils import precompute_undistort_map, parse_system_time
+from utils import cuda_available, opencl_available, configure_opencv, parse_array_text, \
+    list_subdirectories
 from receiver import receive_frames
+from processor import process_frames, load_reference
 from gui_components import Communicate, CollapsibleBox, TimeAxisItem
-from aoi import AOI
+from aoi import AOI, AOIIndex, write_aoi_file, read_aoi_file
+from recorder import GazeRecorder
 import config
 
+# Gaussian blur of the heatmap; OpenCV uses a 121 tap kernel (radius 60) for sigma 15 on float images
+HEATMAP_SIGMA = 15
+HEATMAP_KERNEL_RADIUS = 60
+# The heatmap is blurred at 1/HEATMAP_DOWNSCALE of the reference resolution and upsampled for blending
+HEATMAP_DOWNSCALE = 4
+
+# Number of points shown in the score graph and its redraw interval (independent of the frame rate)
+GRAPH_POINTS = 100
+GRAPH_UPDATE_INTERVAL_MS = 50
+
 
 class GazeApp(QMainWindow):
     def __init__(self):
@@ -54,22 +63,36 @@ class GazeApp(QMainWindow):
         self.current_language = 'ja'  # Default language is Japanese
 
         # Initialize variables
-        self.frame_undistorted = None
         self.ref_image_display = None
+        self.base_image = None               # Last processed image before gaze, heatmap and AOI drawing
+        self.base_buffer = None              # Copy of the last scene overlay image (base_image refers to it while the overlay is on)
+        self.display_buffer = None           # Reusable buffer the display is composed in
+        self.rgb_buffer = None               # Reusable RGB buffer for Qt versions without Format_BGR888
+        self.pixmaps = [QPixmap(), QPixmap()]  # Displayed pixmaps, filled alternately
+        self.pixmap_index = 0
+        self.label_mapping = None            # (offset_x, offset_y, scale_x, scale_y) from label to image coordinates
+        self.label_mapping_key = None        # Label and pixmap sizes label_mapping was computed for
+        self.gaze_ref = None                 # Last gaze point in reference image coordinates
         self.gaze_point_size = 10
         self.gaze_point_color = (0, 0, 255)  # Red color (BGR)
         self.gaze_point_opacity = 1.0        # Opacity (1.0: opaque, 0.0: transparent)
+        self.gaze_sprite = None              # Cached gaze circle (color tile, mask); rebuilt on size/color change
+        self.heatmap_buffer = None           # Reference sized float32 heatmap, only its ROI is written per frame
+        self.heatmap_cache = None            # (ROI and opacity, circle mask, colors, alpha, 1 - alpha) of the last heatmap
         self.show_fps = True
         self.previous_time = time.time()
         self.fps = 0
         self.overlay_scene = False           # Flag for overlaying scene camera
         self.scene_opacity = 0.5             # Opacity for scene camera
         self.aoi_list = []                   # List of AOIs
+        self.aoi_index = AOIIndex()          # Grid index of aoi_list for point lookups
+        self.gaze_aois = []                  # AOIs the gaze is currently inside
+        self.aoi_corners = np.empty((0, 4, 2), dtype=np.int32)  # Corners of each AOI, for drawing
+        self.aoi_corner_owners = []          # aoi_list as it was when aoi_corners was built
         self.drawing_aoi = False             # Whether an AOI is being drawn
         self.aoi_start_point = None          # Start point of AOI
         self.is_configured = False           # Flag indicating configuration is complete
         self.reset_requested = False         # Flag for resetting counts
-        self.previous_frame_shape = None
 
         # Path to GazeVisualizeSoftware folder in user's Documents
         self.base_directory = os.path.join(os.path.expanduser('~/Documents'), 'GazeVisualizeSoftware')
@@ -82,29 +105,40 @@ class GazeApp(QMainWindow):
 
         # Gaze data history
         self.max_history = 100               # Default history frame count
-        self.gaze_history = deque(maxlen=self.max_history)  # Gaze coordinate history
+        self.history_capacity = 1000         # Maximum history frame count (history slider maximum)
+        self.gaze_history = np.empty((self.history_capacity, 2), dtype=np.int32)  # Ring buffer of gaze coordinates
+        self.gaze_head = 0                   # Next write position in gaze_history
+        self.gaze_count = 0                  # Number of valid points in gaze_history (at most max_history)
         self.heatmap_opacity = 0.5           # Heatmap opacity
 
         # Recording related
         self.is_recording = False
-        self.recorded_data = []
-        self.frame_counter = 0  # Frame number in software
+        self.recorder = GazeRecorder()
         self.csv_filename = "recorded_data.csv"
 
-        # Data buffers for graph
-        self.graph_data_right = []
-        self.graph_data_left = []
-        self.graph_time = []
+        # Data buffer for graph: rows time, score right, score left. Points are appended at graph_end;
+        # when the buffer is full the last GRAPH_POINTS - 1 points are moved to the front.
+        self.graph_buffer = np.empty((3, 2 * GRAPH_POINTS), dtype=np.float64)
+        self.graph_end = 0
+        self.graph_changed = False
 
         # Application start time
         self.start_time = None  # Initialized in apply_settings
 
+        # Frame receiving and processing threads and their stop flag
+        self.receive_thread = None
+        self.process_thread = None
+        self.thread_stop = None
+        self.setup_thread = None              # Loads the reference image in apply_settings
+        self.pending_settings = None          # Validated settings waiting for the reference image
+
         # Setup UI
         self.init_ui()
 
         # Signals for inter-thread communication
         self.comm = Communicate()
-        self.comm.update_image.connect(self.update_frame)
+        self.comm.frame_processed.connect(self.on_frame_processed)
+        self.comm.reference_loaded.connect(self.on_reference_loaded)
 
     def init_ui(self):
         self.setWindowTitle(self.tr('視線ポイントビューア'))
@@ -167,12 +201,8 @@ class GazeApp(QMainWindow):
         self.create_menu()
 
     def get_user_list(self):
-        if os.path.exists(self.base_directory):
-            # Get list of user folder names
-            return [name for name in os.listdir(self.base_directory)
-                    if os.path.isdir(os.path.join(self.base_directory, name))]
-        else:
-            return []
+        # Get list of user folder names
+        return list_subdirectories(self.base_directory)
 
     def create_menu(self):
         # Create menu bar
@@ -216,65 +246,76 @@ class GazeApp(QMainWindow):
         self.language_menu.addAction(self.en_action)
 
     def change_language(self, language_code):
-        if language_code == 'ja':
-            self.translator.load('../data/ja.qm')
-            self.current_language = 'ja'
-        elif language_code == 'en':
-            self.translator.load('../data/en.qm')
-            self.current_language = 'en'
-        QApplication.instance().installTranslator(self.translator)
-        self.retranslate_ui()
+        # Suppress repaints while the translator and all texts are replaced
+        self.setUpdatesEnabled(False)
+        try:
+            if language_code == 'ja':
+                self.translator.load('../data/ja.qm')
+                self.current_language = 'ja'
+            elif language_code == 'en':
+                self.translator.load('../data/en.qm')
+                self.current_language = 'en'
+            QApplication.instance().installTranslator(self.translator)
+            self.retranslate_ui()
+        finally:
+            self.setUpdatesEnabled(True)
 
     def retranslate_ui(self):
-        self.setWindowTitle(self.tr('視線ポイントビューア'))
-        # Retranslate menus
-        self.file_menu.setTitle(self.tr('ファイル'))
-        self.save_aoi_action.setText(self.tr('AOIを保存'))
-        self.load_aoi_action.setText(self.tr('AOIを読み込み'))
-        self.view_menu.setTitle(self.tr('表示'))
-        self.toggle_sidebar_action.setText(self.tr('サイドバーを表示'))
-        self.language_menu.setTitle(self.tr('言語'))
-
-        # Reset titles of collapsible group boxes
-        self.initial_settings_group.toggle_button.setText(self.tr('初期設定'))
-        self.other_settings_group.toggle_button.setText(self.tr('その他の設定'))
-        self.heatmap_settings_group.toggle_button.setText(self.tr('ヒートマップ設定'))
-        self.record_settings_group.toggle_button.setText(self.tr('レコード設定'))
-        self.statistics_group.toggle_button.setText(self.tr('統計情報'))
-        self.graph_group.toggle_button.setText(self.tr('リアルタイムグラフ'))
-
-        # Widgets in initial settings group
-        self.image_browse_button.setText(self.tr('参照'))
-        self.image_label_text.setText(self.tr('基準画像ファイル:'))
-        self.zmq_label.setText(self.tr('ZMQアドレス:'))
-        self.camera_matrix_label.setText(self.tr('カメラ行列 (3x3):'))
-        self.camera_matrix_text.setPlaceholderText(self.tr('例: [[fx, 0, cx], [0, fy, cy], [0, 0, 1]]'))
-        self.dist_coeffs_label.setText(self.tr('歪み係数 (5つ):'))
-        self.dist_coeffs_text.setPlaceholderText(self.tr('例: [k1, k2, p1, p2, k3]'))
-        self.configure_button.setText(self.tr('設定完了'))
-
-        # Widgets in other settings group
-        self.size_label.setText(self.tr('視線ポイントのサイズ:'))
-        self.opacity_label.setText(self.tr('視線ポイントの透明度:'))
-        self.color_button.setText(self.tr('視線ポイントの色を選択'))
-        self.fps_checkbox.setText(self.tr('FPSを表示'))
-        self.overlay_checkbox.setText(self.tr('シーンカメラを重ねて表示'))
-        self.scene_opacity_label.setText(self.tr('シーンカメラの透明度:'))
-        self.reset_button.setText(self.tr('カウントリセット'))
-
-        # Widgets in heatmap settings group
-        self.heatmap_checkbox.setText(self.tr('ヒートマップを表示'))
-        self.heatmap_opacity_label.setText(self.tr('ヒートマップの透明度:'))
-        self.history_label.setText(self.tr('履歴フレーム数:'))
-
-        # Widgets in record settings group
-        self.csv_label.setText(self.tr('CSVファイル名:'))
-        self.record_start_button.setText(self.tr('レコード開始'))
-        self.record_stop_button.setText(self.tr('レコード停止'))
-
-        self.session_start_button.setText(self.tr('セッション開始'))
-        self.session_end_button.setText(self.tr('セッション終了'))
-        self.user_label.setText(self.tr('ユーザー名:'))
+        # Apply all text changes with a single relayout/repaint
+        updates_enabled = self.updatesEnabled()
+        self.setUpdatesEnabled(False)
+        try:
+            self.setWindowTitle(self.tr('視線ポイントビューア'))
+            # Retranslate menus
+            self.file_menu.setTitle(self.tr('ファイル'))
+            self.save_aoi_action.setText(self.tr('AOIを保存'))
+            self.load_aoi_action.setText(self.tr('AOIを読み込み'))
+            self.view_menu.setTitle(self.tr('表示'))
+            self.toggle_sidebar_action.setText(self.tr('サイドバーを表示'))
+            self.language_menu.setTitle(self.tr('言語'))
+
+            # Reset titles of collapsible group boxes
+            self.initial_settings_group.toggle_button.setText(self.tr('初期設定'))
+            self.other_settings_group.toggle_button.setText(self.tr('その他の設定'))
+            self.heatmap_settings_group.toggle_button.setText(self.tr('ヒートマップ設定'))
+            self.record_settings_group.toggle_button.setText(self.tr('レコード設定'))
+            self.statistics_group.toggle_button.setText(self.tr('統計情報'))
+            self.graph_group.toggle_button.setText(self.tr('リアルタイムグラフ'))
+
+            # Widgets in initial settings group
+            self.image_browse_button.setText(self.tr('参照'))
+            self.image_label_text.setText(self.tr('基準画像ファイル:'))
+            self.zmq_label.setText(self.tr('ZMQアドレス:'))
+            self.camera_matrix_label.setText(self.tr('カメラ行列 (3x3):'))
+            self.camera_matrix_text.setPlaceholderText(self.tr('例: [[fx, 0, cx], [0, fy, cy], [0, 0, 1]]'))
+            self.dist_coeffs_label.setText(self.tr('歪み係数 (5つ):'))
+            self.dist_coeffs_text.setPlaceholderText(self.tr('例: [k1, k2, p1, p2, k3]'))
+            self.configure_button.setText(self.tr('設定完了'))
+
+            # Widgets in other settings group
+            self.size_label.setText(self.tr('視線ポイントのサイズ:'))
+            self.opacity_label.setText(self.tr('視線ポイントの透明度:'))
+            self.color_button.setText(self.tr('視線ポイントの色を選択'))
+            self.fps_checkbox.setText(self.tr('FPSを表示'))
+            self.overlay_checkbox.setText(self.tr('シーンカメラを重ねて表示'))
+            self.scene_opacity_label.setText(self.tr('シーンカメラの透明度:'))
+            self.reset_button.setText(self.tr('カウントリセット'))
+
+            # Widgets in heatmap settings group
+            self.heatmap_checkbox.setText(self.tr('ヒートマップを表示'))
+            self.heatmap_opacity_label.setText(self.tr('ヒートマップの透明度:'))
+            self.history_label.setText(self.tr('履歴フレーム数:'))
+
+            # Widgets in record settings group
+            self.csv_label.setText(self.tr('CSVファイル名:'))
+            self.record_start_button.setText(self.tr('レコード開始'))
+            self.record_stop_button.setText(self.tr('レコード停止'))
+
+            self.session_start_button.setText(self.tr('セッション開始'))
+            self.session_end_button.setText(self.tr('セッション終了'))
+            self.user_label.setText(self.tr('ユーザー名:'))
+        finally:
+            self.setUpdatesEnabled(updates_enabled)
 
     def toggle_sidebar(self, state):
         self.sidebar_widget.setVisible(state)
@@ -344,10 +385,7 @@ class GazeApp(QMainWindow):
 
     def get_session_list(self):
         if self.current_user:
-            user_directory = os.path.join(self.base_directory, self.current_user)
-            if os.path.exists(user_directory):
-                return [name for name in os.listdir(user_directory)
-                        if os.path.isdir(os.path.join(user_directory, name))]
+            return list_subdirectories(os.path.join(self.base_directory, self.current_user))
         return []
 
     def create_initial_settings_group(self):
@@ -524,7 +562,7 @@ class GazeApp(QMainWindow):
         history_layout = QHBoxLayout()
         self.history_slider = QSlider(Qt.Horizontal)
         self.history_slider.setMinimum(1)
-        self.history_slider.setMaximum(1000)
+        self.history_slider.setMaximum(self.history_capacity)
         self.history_slider.setValue(self.max_history)
         self.history_slider.setTickPosition(QSlider.TicksBelow)
         self.history_slider.setTickInterval(100)
@@ -598,6 +636,10 @@ class GazeApp(QMainWindow):
         self.plot_widget.setBackground('w')
         self.plot_widget.addLegend()
         self.plot_widget.showGrid(x=True, y=True)
+        # The x range follows the rolling window in update_graph; only y is auto-ranged,
+        # and only over the visible points
+        self.plot_widget.disableAutoRange(axis='x')
+        self.plot_widget.getViewBox().setAutoVisible(y=True)
 
         # Create data lines
         self.score_right_line = self.plot_widget.plot(pen='r', name='Score Right')
@@ -606,6 +648,23 @@ class GazeApp(QMainWindow):
         layout.addWidget(self.plot_widget)
         self.graph_group.setContentLayout(layout)
 
+        # Redraw the graph at a fixed rate instead of for every frame
+        self.graph_timer = QTimer(self)
+        self.graph_timer.timeout.connect(self.update_graph)
+        self.graph_timer.start(GRAPH_UPDATE_INTERVAL_MS)
+
+    def update_graph(self):
+        if not self.graph_changed:
+            return
+        start = max(0, self.graph_end - GRAPH_POINTS)
+        # pyqtgraph keeps the arrays it is given, so it gets a copy of the shown window
+        graph_time, score_right, score_left = self.graph_buffer[:, start:self.graph_end].copy()
+        self.score_right_line.setData(graph_time, score_right)
+        self.score_left_line.setData(graph_time, score_left)
+        if graph_time[-1] > graph_time[0]:
+            self.plot_widget.setXRange(graph_time[0], graph_time[-1], padding=0)
+        self.graph_changed = False
+
     def change_heatmap_opacity(self, value):
         self.heatmap_opacity = value / 100.0
         self.heatmap_opacity_value_label.setText(str(value))
@@ -613,8 +672,8 @@ class GazeApp(QMainWindow):
     def change_history(self, value):
         self.max_history = value
         self.history_value_label.setText(str(value))
-        # Update maxlen of gaze_history
-        self.gaze_history = deque(self.gaze_history, maxlen=self.max_history)
+        # Drop the oldest points if the history became shorter
+        self.gaze_count = min(self.gaze_count, self.max_history)
 
     def reset_counts(self):
         for aoi in self.aoi_list:
@@ -638,17 +697,15 @@ class GazeApp(QMainWindow):
             QMessageBox.warning(self, self.tr("エラー"), self.tr("基準画像ファイルを選択してください。"))
             return
 
-        config.ref_image = cv2.imread(image_path)
-        if config.ref_image is None:
-            QMessageBox.warning(self, self.tr("エラー"), self.tr("基準画像の読み込みに失敗しました。"))
+        # Settings are applied once the reference image has been loaded
+        if self.setup_thread is not None and self.setup_thread.is_alive():
             return
 
         # Get camera matrix
         try:
             camera_matrix_str = self.camera_matrix_text.toPlainText()
-            camera_matrix_values = ast.literal_eval(camera_matrix_str)
-            config.camera_matrix = np.array(camera_matrix_values, dtype=np.float64)
-            if config.camera_matrix.shape != (3, 3):
+            camera_matrix = parse_array_text(camera_matrix_str)
+            if camera_matrix.shape != (3, 3):
                 raise ValueError
         except Exception:
             QMessageBox.warning(self, self.tr("エラー"), self.tr("カメラ行列の値を正しく入力してください。"))
@@ -657,9 +714,8 @@ class GazeApp(QMainWindow):
         # Get distortion coefficients
         try:
             dist_coeffs_str = self.dist_coeffs_text.toPlainText()
-            dist_coeffs_values = ast.literal_eval(dist_coeffs_str)
-            config.dist_coeffs = np.array(dist_coeffs_values, dtype=np.float64)
-            if config.dist_coeffs.shape[0] != 5:
+            dist_coeffs = parse_array_text(dist_coeffs_str)
+            if dist_coeffs.shape[0] != 5:
                 raise ValueError
         except Exception:
             QMessageBox.warning(self, self.tr("エラー"), self.tr("歪み係数の値を正しく入力してください。"))
@@ -669,51 +725,102 @@ class GazeApp(QMainWindow):
             QMessageBox.warning(self, self.tr("エラー"), self.tr("ユーザー名を入力してください。"))
             return
 
-        # Initialize ORB feature detector
-        config.orb = cv2.ORB_create(nfeatures=300, fastThreshold=7, scaleFactor=1.2,
-                                 nlevels=8, edgeThreshold=31, patchSize=31)
-
-        # Compute keypoints and descriptors for reference image
-        config.ref_gray = cv2.cvtColor(config.ref_image, cv2.COLOR_BGR2GRAY)
-        config.ref_keypoints, config.ref_descriptors = config.orb.detectAndCompute(config.ref_gray, None)
-
-        # Create matcher (FlannBasedMatcher)
-        FLANN_INDEX_LSH = 6
-        index_params = dict(algorithm=FLANN_INDEX_LSH,
-                            table_number=6,
-                            key_size=12,
-                            multi_probe_level=1)
-        search_params = dict(checks=50)
-        config.flann = cv2.FlannBasedMatcher(index_params, search_params)
-
-        # Precompute undistortion map for frames (with dummy frame size)
-        dummy_frame = np.zeros_like(config.ref_image)
-        config.map1_frame, config.map2_frame, config.roi_frame, config.new_camera_mtx_frame = precompute_undistort_map(
-            dummy_frame.shape, config.camera_matrix, config.dist_coeffs)
-
-        # Get ZMQ address
-        zmq_address = self.zmq_address_edit.text()
+        # Load the reference image and compute its features in a worker thread;
+        # on_reference_loaded finishes the configuration
+        self.pending_settings = (camera_matrix, dist_coeffs, self.zmq_address_edit.text())
+        self.configure_button.setEnabled(False)
+        self.setup_thread = threading.Thread(target=load_reference, args=(image_path, self.comm))
+        self.setup_thread.daemon = True
+        self.setup_thread.start()
+
+    def on_reference_loaded(self, result):
+        self.configure_button.setEnabled(True)
+        if result.get('error') == 'read':
+            QMessageBox.warning(self, self.tr("エラー"), self.tr("基準画像の読み込みに失敗しました。"))
+            return
+        if result.get('error') == 'features':
+            QMessageBox.warning(self, self.tr("エラー"), self.tr("基準画像から特徴点を検出できませんでした。"))
+            return
+        camera_matrix, dist_coeffs, zmq_address = self.pending_settings
+
+        # Initialize ORB feature detector and matcher once; they keep no per-image state,
+        # so re-applying the settings reuses them
+        if config.orb is None:
+            config.orb = cv2.ORB_create(**config.orb_params)
+            # Brute-force Hamming matcher; cheaper than building an LSH index per frame
+            config.matcher = cv2.BFMatcher_create(cv2.NORM_HAMMING, crossCheck=False)
+            config.cross_check_matcher = cv2.BFMatcher_create(cv2.NORM_HAMMING, crossCheck=True)
+
+        # Stop the threads started by a previous configuration before changing the shared settings
+        if self.receive_thread is not None:
+            self.thread_stop.set()
+            self.receive_thread.join()
+            self.process_thread.join()
+
+        # Reference image (BGR) for the scene overlay, contiguous for the blend and copy paths
+        config.ref_image = result['ref_image']
+        config.camera_matrix = camera_matrix
+        config.dist_coeffs = dist_coeffs
+
+        config.ref_gray = result['ref_gray']
+        config.ref_keypoints = result['ref_keypoints']
+        config.ref_descriptors = result['ref_descriptors']
+
+        # Use CUDA ORB and brute-force Hamming matcher if available, keeping the
+        # reference descriptors resident in GPU memory
+        config.use_cuda = cuda_available()
+        if config.use_cuda:
+            if config.cuda_orb is None:
+                config.cuda_stream = cv2.cuda_Stream()
+                config.cuda_orb = cv2.cuda_ORB.create(**config.orb_params)
+                config.cuda_matcher = cv2.cuda.DescriptorMatcher_createBFMatcher(cv2.NORM_HAMMING)
+                config.frame_gpu = cv2.cuda_GpuMat()
+            ref_gray_gpu = cv2.cuda_GpuMat()
+            ref_gray_gpu.upload(config.ref_gray, config.cuda_stream)
+            ref_keypoints_gpu, config.ref_descriptors_gpu = config.cuda_orb.detectAndComputeAsync(
+                ref_gray_gpu, None, stream=config.cuda_stream)
+            config.cuda_stream.waitForCompletion()
+            config.ref_keypoints = config.cuda_orb.convert(ref_keypoints_gpu)
+            # Reference image for the scene overlay and reusable device buffers
+            config.ref_image_gpu = cv2.cuda_GpuMat()
+            config.ref_image_gpu.upload(config.ref_image)
+            config.undistorted_gpu = cv2.cuda_GpuMat()
+            config.warped_gpu = cv2.cuda_GpuMat()
+            config.blended_gpu = cv2.cuda_GpuMat()
+
+        # Otherwise run the CPU pipeline on cv2.UMat so OpenCV can use an OpenCL device
+        config.use_opencl = not config.use_cuda and opencl_available()
+
+        # Reference keypoint coordinates as an (N, 2) float32 array for fast indexing
+        config.ref_pts = cv2.KeyPoint_convert(config.ref_keypoints)
+
+        # Nothing has been processed with the new settings yet
+        self.gaze_ref = None
+        config.overlay_settings['overlay_scene'] = self.overlay_scene
+        config.overlay_settings['scene_opacity'] = self.scene_opacity
 
         # Start frame receiving thread
-        self.receive_thread = threading.Thread(target=receive_frames, args=(zmq_address,))
+        self.thread_stop = threading.Event()
+        self.receive_thread = threading.Thread(target=receive_frames, args=(zmq_address, self.thread_stop))
         self.receive_thread.daemon = True
         self.receive_thread.start()
 
+        # Start frame processing thread; results arrive through the frame_processed signal
+        self.process_thread = threading.Thread(target=process_frames, args=(self.comm, self.thread_stop))
+        self.process_thread.daemon = True
+        self.process_thread.start()
+
         # After configuration, enable control panel
         self.is_configured = True
         # Enable menu bar
         self.menuBar().setEnabled(True)
 
-        # Start timer for frame updates
-        self.timer = QTimer()
-        self.timer.timeout.connect(self.update_frame)
-        self.timer.start(16)  # Update at approximately 60 FPS
-
         # Set application start time
         self.start_time = time.time()
 
     def change_point_size(self, value):
         self.gaze_point_size = value
+        self.gaze_sprite = None
         self.size_value_label.setText(str(value))
 
     def change_opacity(self, value):
@@ -722,6 +829,7 @@ class GazeApp(QMainWindow):
 
     def change_scene_opacity(self, value):
         self.scene_opacity = value / 100.0
+        config.overlay_settings['scene_opacity'] = self.scene_opacity
         self.scene_opacity_value_label.setText(str(value))
 
     def select_color(self):
@@ -730,12 +838,14 @@ class GazeApp(QMainWindow):
             # Convert QColor to BGR tuple
             self.gaze_point_color = (
                 color.blue(), color.green(), color.red())
+            self.gaze_sprite = None
 
     def toggle_fps(self, state):
         self.show_fps = state == Qt.Checked
 
     def toggle_overlay(self, state):
         self.overlay_scene = state == Qt.Checked
+        config.overlay_settings['overlay_scene'] = self.overlay_scene
 
     def save_aoi(self):
         options = QFileDialog.Options()
@@ -749,8 +859,7 @@ class GazeApp(QMainWindow):
                         'name': aoi.name,
                         'rect': [aoi.rect.left(), aoi.rect.top(), aoi.rect.width(), aoi.rect.height()]
                     })
-                with open(filename, 'w', encoding='utf-8') as f:
-                    json.dump(aoi_data, f, ensure_ascii=False, indent=4)
+                write_aoi_file(filename, aoi_data)
                 QMessageBox.information(self, self.tr("保存完了"), self.tr("AOIを保存しました。"))
             except Exception as e:
                 QMessageBox.warning(self, self.tr("エラー"), f"{self.tr('AOIの保存中にエラーが発生しました:')} {e}")
@@ -761,15 +870,17 @@ class GazeApp(QMainWindow):
             self, self.tr("AOIを読み込み"), "", self.tr("AOIファイル (*.aoi);;全てのファイル (*)"), options=options)
         if filename:
             try:
-                with open(filename, 'r', encoding='utf-8') as f:
-                    aoi_data = json.load(f)
+                aoi_data = read_aoi_file(filename)
                 self.aoi_list.clear()
+                self.aoi_index.clear()
+                self.gaze_aois = []
                 for item in aoi_data:
                     name = item['name']
                     left, top, width, height = item['rect']
                     rect = QRectF(left, top, width, height)
                     aoi = AOI(rect, name)
                     self.aoi_list.append(aoi)
+                    self.aoi_index.insert(aoi)
                 self.update_frame()
                 QMessageBox.information(self, self.tr("読み込み完了"), self.tr("AOIを読み込みました。"))
             except Exception as e:
@@ -779,26 +890,14 @@ class GazeApp(QMainWindow):
         if event.button() == Qt.LeftButton and self.is_configured:
             # Convert click position to coordinates in reference image
             pos = event.pos()
-            pixmap = self.image_label.pixmap()
-            if pixmap:
-                label_rect = self.image_label.contentsRect()
-                label_width = label_rect.width()
-                label_height = label_rect.height()
-                pixmap_width = pixmap.width()
-                pixmap_height = pixmap.height()
-                scaled_w = pixmap_width * min(label_width / pixmap_width, label_height / pixmap_height)
-                scaled_h = pixmap_height * min(label_width / pixmap_width, label_height / pixmap_height)
-                offset_x = (label_width - scaled_w) / 2
-                offset_y = (label_height - scaled_h) / 2
-                scale_x = pixmap_width / scaled_w
-                scale_y = pixmap_height / scaled_h
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
                 x = (pos.x() - offset_x) * scale_x
                 y = (pos.y() - offset_y) * scale_y
-                # Check if click is inside an existing AOI
-                for aoi in reversed(self.aoi_list):
-                    if aoi.rect.contains(QPointF(x, y)):
-                        # If inside existing AOI, do not start new AOI
-                        return
+                # If inside existing AOI, do not start new AOI
+                if self.aoi_index.query(x, y):
+                    return
             # Start creating new AOI
             self.drawing_aoi = True
             self.aoi_start_point = event.pos()
@@ -816,19 +915,9 @@ class GazeApp(QMainWindow):
             start = self.aoi_start_point
             end = self.aoi_end_point
             # Scale coordinates to reference image
-            pixmap = self.image_label.pixmap()
-            if pixmap:
-                label_rect = self.image_label.contentsRect()
-                label_width = label_rect.width()
-                label_height = label_rect.height()
-                pixmap_width = pixmap.width()
-                pixmap_height = pixmap.height()
-                scaled_w = pixmap_width * min(label_width / pixmap_width, label_height / pixmap_height)
-                scaled_h = pixmap_height * min(label_width / pixmap_width, label_height / pixmap_height)
-                offset_x = (label_width - scaled_w) / 2
-                offset_y = (label_height - scaled_h) / 2
-                scale_x = pixmap_width / scaled_w
-                scale_y = pixmap_height / scaled_h
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
                 start_x = (start.x() - offset_x) * scale_x
                 start_y = (start.y() - offset_y) * scale_y
                 end_x = (end.x() - offset_x) * scale_x
@@ -836,35 +925,26 @@ class GazeApp(QMainWindow):
                 rect = QRectF(QPointF(start_x, start_y), QPointF(end_x, end_y))
                 aoi = AOI(rect.normalized())
                 self.aoi_list.append(aoi)
+                self.aoi_index.insert(aoi)
                 self.update_frame()
 
     def image_mouse_double_click_event(self, event):
         if self.is_configured:
             # Convert click position to coordinates in reference image
             pos = event.pos()
-            pixmap = self.image_label.pixmap()
-            if pixmap:
-                label_rect = self.image_label.contentsRect()
-                label_width = label_rect.width()
-                label_height = label_rect.height()
-                pixmap_width = pixmap.width()
-                pixmap_height = pixmap.height()
-                scaled_w = pixmap_width * min(label_width / pixmap_width, label_height / pixmap_height)
-                scaled_h = pixmap_height * min(label_width / pixmap_width, label_height / pixmap_height)
-                offset_x = (label_width - scaled_w) / 2
-                offset_y = (label_height - scaled_h) / 2
-                scale_x = pixmap_width / scaled_w
-                scale_y = pixmap_height / scaled_h
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
                 x = (pos.x() - offset_x) * scale_x
                 y = (pos.y() - offset_y) * scale_y
                 # Check if click is inside an AOI
-                for aoi in reversed(self.aoi_list):
-                    if aoi.rect.contains(QPointF(x, y)):
-                        # Show dialog to change AOI name
-                        text, ok = QInputDialog.getText(self, self.tr('AOIの名前を設定'), self.tr('AOIの名前:'), text=aoi.name)
-                        if ok:
-                            aoi.name = text
-                        break
+                aois = self.aoi_index.query(x, y)
+                if aois:
+                    aoi = aois[-1]
+                    # Show dialog to change AOI name
+                    text, ok = QInputDialog.getText(self, self.tr('AOIの名前を設定'), self.tr('AOIの名前:'), text=aoi.name)
+                    if ok:
+                        aoi.name = text
 
     def contextMenuEvent(self, event):
         if not self.is_configured:
@@ -873,45 +953,35 @@ class GazeApp(QMainWindow):
         if self.image_label.geometry().contains(pos):
             # Convert click position to image coordinates
             img_pos = self.image_label.mapFromParent(pos)
-            pixmap = self.image_label.pixmap()
-            if pixmap:
-                label_rect = self.image_label.contentsRect()
-                label_width = label_rect.width()
-                label_height = label_rect.height()
-                pixmap_width = pixmap.width()
-                pixmap_height = pixmap.height()
-                scaled_w = pixmap_width * min(label_width / pixmap_width, label_height / pixmap_height)
-                scaled_h = pixmap_height * min(label_width / pixmap_width, label_height / pixmap_height)
-                offset_x = (label_width - scaled_w) / 2
-                offset_y = (label_height - scaled_h) / 2
-                scale_x = pixmap_width / scaled_w
-                scale_y = pixmap_height / scaled_h
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
                 x = (img_pos.x() - offset_x) * scale_x
                 y = (img_pos.y() - offset_y) * scale_y
                 # Check if click is inside an AOI
-                for aoi in reversed(self.aoi_list):
-                    if aoi.rect.contains(QPointF(x, y)):
-                        # Create context menu
-                        menu = QMenu(self)
-                        rename_action = menu.addAction(self.tr('AOIの名前を変更'))
-                        delete_action = menu.addAction(self.tr('AOIを削除'))
-                        action = menu.exec_(self.mapToGlobal(pos))
-                        if action == rename_action:
-                            text, ok = QInputDialog.getText(self, self.tr('AOIの名前を設定'), self.tr('AOIの名前:'), text=aoi.name)
-                            if ok:
-                                aoi.name = text
-                        elif action == delete_action:
-                            self.aoi_list.remove(aoi)
-                            self.update_frame()
-                        break
+                aois = self.aoi_index.query(x, y)
+                if aois:
+                    aoi = aois[-1]
+                    # Create context menu
+                    menu = QMenu(self)
+                    rename_action = menu.addAction(self.tr('AOIの名前を変更'))
+                    delete_action = menu.addAction(self.tr('AOIを削除'))
+                    action = menu.exec_(self.mapToGlobal(pos))
+                    if action == rename_action:
+                        text, ok = QInputDialog.getText(self, self.tr('AOIの名前を設定'), self.tr('AOIの名前:'), text=aoi.name)
+                        if ok:
+                            aoi.name = text
+                    elif action == delete_action:
+                        self.aoi_list.remove(aoi)
+                        self.aoi_index.remove(aoi)
+                        if aoi in self.gaze_aois:
+                            self.gaze_aois.remove(aoi)
+                        self.update_frame()
 
     def start_recording(self):
         if not self.current_session:
             QMessageBox.warning(self, self.tr("エラー"), self.tr("セッションを開始してください。"))
             return
-        self.is_recording = True
-        self.recorded_data = []
-        self.frame_counter = 0
 
         # Set save directory
         self.session_directory = os.path.join(self.base_directory, self.current_user, self.current_session)
@@ -926,6 +996,14 @@ class GazeApp(QMainWindow):
             index += 1
         self.csv_filename = csv_filename
 
+        # Rows are streamed to the file while recording
+        try:
+            self.recorder.open(self.csv_filename)
+        except OSError as e:
+            QMessageBox.warning(self, self.tr("エラー"), f"{self.tr('データの保存中にエラーが発生しました:')} {e}")
+            return
+        self.is_recording = True
+
         self.csv_filename_edit.setEnabled(False)
         # Toggle button states
         self.record_start_button.setEnabled(False)
@@ -933,23 +1011,21 @@ class GazeApp(QMainWindow):
 
     def stop_recording(self):
         self.is_recording = False
-        # Save data to CSV file
-        try:
-            with open(self.csv_filename, 'w', newline='', encoding='utf-8') as csvfile:
-                fieldnames = ['Frame', 'PicNum', 'GazeX', 'GazeY', 'AOI', 'ScoreRight', 'ScoreLeft', 'SystemTime']
-                writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-                writer.writeheader()
-                for data in self.recorded_data:
-                    writer.writerow(data)
-            QMessageBox.information(self, self.tr("保存完了"), f"{self.csv_filename} {self.tr('にデータを保存しました。')}")
-        except Exception as e:
-            QMessageBox.warning(self, self.tr("エラー"), f"{self.tr('データの保存中にエラーが発生しました:')} {e}")
-
         self.csv_filename_edit.setEnabled(True)
         # Toggle button states
         self.record_start_button.setEnabled(True)
         self.record_stop_button.setEnabled(False)
 
+        # Nothing was recorded (e.g. the session ends without a recording), so there is no file to save
+        if self.recorder.file is None:
+            return
+        # Write the remaining rows and close the CSV file
+        try:
+            self.recorder.close()
+            QMessageBox.information(self, self.tr("保存完了"), f"{self.csv_filename} {self.tr('にデータを保存しました。')}")
+        except Exception as e:
+            QMessageBox.warning(self, self.tr("エラー"), f"{self.tr('データの保存中にエラーが発生しました:')} {e}")
+
     def update_statistics(self):
         # Clear statistics layout
         for i in reversed(range(self.statistics_layout.count())):
@@ -972,267 +1048,287 @@ class GazeApp(QMainWindow):
             label = QLabel(label_text)
             self.statistics_layout.addWidget(label)
 
+    def on_frame_processed(self, result):
+        image = result['image']
+        if image is config.ref_image:
+            # The unmodified reference image is never written, so it is used without a copy
+            self.base_image = image
+        else:
+            # Keep a copy of the overlay image so the processing thread can reuse its buffer
+            if self.base_buffer is None or self.base_buffer.shape != image.shape:
+                self.base_buffer = np.empty_like(image)
+            np.copyto(self.base_buffer, image)
+            self.base_image = self.base_buffer
+        config.result_consumed.set()
+
+        x_ref, y_ref = result['gaze_ref']
+        self.gaze_ref = (x_ref, y_ref)
+        score_right = result['score_right']
+        score_left = result['score_left']
+        system_time_str = result['system_time']
+
+        # Add gaze data to history
+        self.gaze_history[self.gaze_head] = (int(x_ref), int(y_ref))
+        self.gaze_head = (self.gaze_head + 1) % self.history_capacity
+        self.gaze_count = min(self.gaze_count + 1, self.max_history)
+
+        # Hold current system time
+        self.current_system_time = result['timestamp']
+
+        # AOI processing
+        # Only the AOIs under the gaze point and those it was inside can change state
+        gaze_aois = self.aoi_index.query(x_ref, y_ref)
+        for aoi in self.gaze_aois:
+            if aoi not in gaze_aois:
+                # Gaze exited AOI
+                if aoi.entry_time is not None:
+                    aoi.dwell_time += self.current_system_time - aoi.entry_time
+                    aoi.entry_time = None
+                aoi.is_gaze_inside = False
+        for aoi in gaze_aois:
+            if not aoi.is_gaze_inside:
+                # Gaze entered AOI
+                aoi.hit_count += 1
+                aoi.entry_time = self.current_system_time
+            aoi.is_gaze_inside = True
+        self.gaze_aois = gaze_aois
+        gaze_aoi_name = gaze_aois[-1].name if gaze_aois else ''
+
+        # Update statistics
+        self.update_statistics()
+
+        # Calculate FPS
+        current_time = time.time()
+        self.fps = 1 / (current_time - self.previous_time)
+        self.previous_time = current_time
+
+        # Compose and display image
+        self.update_frame()
+
+        # Update graph data (plotted by update_graph)
+        if self.graph_end == self.graph_buffer.shape[1]:
+            self.graph_buffer[:, :GRAPH_POINTS - 1] = self.graph_buffer[:, self.graph_end - GRAPH_POINTS + 1:]
+            self.graph_end = GRAPH_POINTS - 1
+        self.graph_buffer[:, self.graph_end] = (self.current_system_time, score_right, score_left)
+        self.graph_end += 1
+        self.graph_changed = True
+
+        # If recording is active, record data
+        if self.is_recording:
+            self.recorder.append(result['pic_num'], x_ref, y_ref, gaze_aoi_name,
+                                 score_right, score_left, system_time_str)
+
+    def recent_gaze_points(self):
+        # Last gaze_count points of the ring buffer as an (N, 2) array
+        start = self.gaze_head - self.gaze_count
+        if start >= 0:
+            return self.gaze_history[start:self.gaze_head]
+        return np.concatenate((self.gaze_history[start:], self.gaze_history[:self.gaze_head]))
+
+    def build_gaze_sprite(self):
+        # Rasterize the gaze circle once as a (2r+1)x(2r+1) color tile and coverage mask
+        r = self.gaze_point_size
+        sprite = np.empty((2 * r + 1, 2 * r + 1, 3), dtype=np.uint8)
+        sprite[:] = self.gaze_point_color
+        sprite_mask = np.zeros((2 * r + 1, 2 * r + 1), dtype=np.uint8)
+        cv2.circle(sprite_mask, (r, r), r, 255, -1)
+        return sprite, sprite_mask.astype(bool)
+
+    def apply_heatmap(self):
+        # The blurred heatmap is zero farther than the circle radius plus the kernel radius from
+        # every gaze point, so only that bounding box is rasterized, blurred and blended
+        h_ref, w_ref = self.ref_image_display.shape[:2]
+        r = self.gaze_point_size
+        points = self.recent_gaze_points()
+        # Points whose circle lies completely outside the image do not contribute
+        points = points[(points[:, 0] >= -r) & (points[:, 0] < w_ref + r) &
+                        (points[:, 1] >= -r) & (points[:, 1] < h_ref + r)]
+        if len(points) == 0:
+            return
+        pad = r + HEATMAP_KERNEL_RADIUS
+        x0 = max(0, int(points[:, 0].min()) - pad)
+        y0 = max(0, int(points[:, 1].min()) - pad)
+        x1 = min(w_ref, int(points[:, 0].max()) + pad + 1)
+        y1 = min(h_ref, int(points[:, 1].max()) + pad + 1)
+
+        # Filled circles around all points at once: mark the centers and dilate with a disk,
+        # on a canvas extended by r so circles centered just outside the ROI are clipped too
+        canvas = np.zeros((y1 - y0 + 2 * r, x1 - x0 + 2 * r), dtype=np.uint8)
+        canvas[points[:, 1] - y0 + r, points[:, 0] - x0 + r] = 255
+        disk = np.zeros((2 * r + 1, 2 * r + 1), dtype=np.uint8)
+        cv2.circle(disk, (r, r), r, 1, -1)
+        canvas = cv2.dilate(canvas, disk)
+
+        # While the gaze rests, new points fall on pixels already covered and the circle mask does
+        # not change, so the colors and alpha of the last heatmap are blended again as they are
+        key = (w_ref, h_ref, x0, y0, x1, y1, self.heatmap_opacity)
+        cache = self.heatmap_cache
+        if cache is None or cache[0] != key or not np.array_equal(cache[1], canvas):
+            self.heatmap_cache = cache = (key, canvas) + self.render_heatmap(canvas, r, x0, y0, x1, y1)
+        heatmap_color, alpha, beta = cache[2:]
+
+        # Apply heatmap with a per-pixel alpha based on intensity, blending the uint8 images
+        # in place in one pass instead of converting them to float
+        display_roi = self.ref_image_display[y0:y1, x0:x1]
+        cv2.blendLinear(heatmap_color, display_roi, alpha, beta, dst=display_roi)
+
+    def render_heatmap(self, canvas, r, x0, y0, x1, y1):
+        # Blur at reduced resolution: the circles are area-averaged down (keeping their coverage),
+        # and the blurred result is smooth enough to be upsampled linearly without visible loss
+        h_ref, w_ref = self.ref_image_display.shape[:2]
+        roi_w, roi_h = x1 - x0, y1 - y0
+        small_size = (-(-roi_w // HEATMAP_DOWNSCALE), -(-roi_h // HEATMAP_DOWNSCALE))
+        small = cv2.resize(canvas[r:r + roi_h, r:r + roi_w], small_size, interpolation=cv2.INTER_AREA)
+        small = small.astype(np.float32)
+        sigma = HEATMAP_SIGMA / HEATMAP_DOWNSCALE
+        cv2.GaussianBlur(small, (0, 0), sigmaX=sigma, sigmaY=sigma, dst=small)
+        # Unless the ROI covers the whole image the minimum is 0 (outside the ROI), so scaling
+        # the maximum to 255 equals min-max normalization over the image
+        if (roi_h, roi_w) == (h_ref, w_ref):
+            cv2.normalize(small, small, 0, 255, cv2.NORM_MINMAX)
+        else:
+            cv2.normalize(small, small, 255, 0, cv2.NORM_INF)
+
+        if self.heatmap_buffer is None or self.heatmap_buffer.shape != (h_ref, w_ref):
+            self.heatmap_buffer = np.empty((h_ref, w_ref), dtype=np.float32)
+        heatmap = self.heatmap_buffer[y0:y1, x0:x1]
+        cv2.resize(small, (roi_w, roi_h), dst=heatmap, interpolation=cv2.INTER_LINEAR)
+        heatmap_color = cv2.applyColorMap(heatmap.astype(np.uint8), cv2.COLORMAP_JET)
+        # Per-pixel blend weights based on intensity
+        alpha = heatmap * (self.heatmap_opacity / 255.0)
+        return heatmap_color, alpha, 1.0 - alpha
+
     def update_frame(self, draw_aoi_preview=False):
-        if not self.is_configured:
+        # Draw heatmap, gaze point and AOIs over the last processed image
+        if not self.is_configured or self.gaze_ref is None:
             return
 
-        if config.frame_available.is_set() or draw_aoi_preview:
-            if not draw_aoi_preview:
-                config.frame_available.clear()
-
-            with config.frame_lock:
-                frame_proc = config.shared_data['frame']
-                gaze_x = config.shared_data['gaze_x']
-                gaze_y = config.shared_data['gaze_y']
-                pic_num = config.shared_data['frame_num']
-                score_right = config.shared_data['score_right']
-                score_left = config.shared_data['score_left']
-                system_time_str = config.shared_data['system_time']
-
-            if frame_proc is None:
-                return
-
-            # Check if frame size has changed; recompute undistortion map if necessary
-            if self.previous_frame_shape != frame_proc.shape[:2]:
-                # config.map1_frame, config.map2_frame, config.roi_frame, config.new_camera_mtx_frame = precompute_undistort_map(frame_proc.shape)
-                config.map1_frame, config.map2_frame, config.roi_frame, config.new_camera_mtx_frame = precompute_undistort_map(frame_proc.shape, config.camera_matrix, config.dist_coeffs)
-                self.previous_frame_shape = frame_proc.shape[:2]
-
-            # Scale gaze coordinates to image size
-            h_frame, w_frame = frame_proc.shape[:2]
-            gaze_x = gaze_x * w_frame
-            gaze_y = gaze_y * h_frame
-
-            # Undistort the frame
-            frame_undistorted = cv2.remap(
-                frame_proc, config.map1_frame, config.map2_frame, cv2.INTER_LINEAR)
-            x, y, w, h = config.roi_frame
-            frame_undistorted = frame_undistorted[y:y+h, x:x+w]
-
-            # Undistort gaze coordinates
-            gaze_point = np.array([[gaze_x, gaze_y]], dtype=np.float32).reshape(-1, 1, 2)
-            gaze_point_undistorted = cv2.undistortPoints(
-                gaze_point, config.camera_matrix, config.dist_coeffs, P=config.new_camera_mtx_frame)
-            gaze_x_ud, gaze_y_ud = gaze_point_undistorted[0][0]
-            gaze_x_ud -= x  # Adjust for cropping
-            gaze_y_ud -= y  # Adjust for cropping
-
-            # Convert frame to grayscale
-            frame_gray = cv2.cvtColor(frame_undistorted, cv2.COLOR_BGR2GRAY)
-
-            # Compute keypoints and descriptors for the frame
-            frame_keypoints, frame_descriptors = config.orb.detectAndCompute(frame_gray, None)
-
-            if frame_descriptors is not None and len(frame_descriptors) > 0:
-                # Perform matching
-                matches = config.flann.knnMatch(config.ref_descriptors, frame_descriptors, k=2)
-
-                # Apply ratio test
-                good_matches = []
-                for m_n in matches:
-                    if len(m_n) == 2:
-                        m, n = m_n
-                        if m.distance < 0.75 * n.distance:
-                            good_matches.append(m)
-
-                if len(good_matches) > 10:
-                    src_pts = np.float32(
-                        [config.ref_keypoints[m.queryIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-                    dst_pts = np.float32(
-                        [frame_keypoints[m.trainIdx].pt for m in good_matches]).reshape(-1, 1, 2)
-
-                    # Compute homography matrix
-                    M, mask = cv2.findHomography(dst_pts, src_pts, cv2.RANSAC, 5.0)
-
-                    # Transform gaze point to reference image coordinates
-                    if M is not None:
-                        gaze_point_ref = cv2.perspectiveTransform(
-                            np.array([[[gaze_x_ud, gaze_y_ud]]], dtype=np.float32), M)
-                        x_ref, y_ref = gaze_point_ref[0][0]
-
-                        # Add gaze data to history
-                        self.gaze_history.append((int(x_ref), int(y_ref)))
-                        if len(self.gaze_history) > self.max_history:
-                            self.gaze_history.popleft()
-
-                        # Copy reference image for display
-                        self.ref_image_display = config.ref_image.copy()
-
-                        # Overlay scene camera if enabled
-                        if self.overlay_scene:
-                            h_ref, w_ref = config.ref_image.shape[:2]
-                            warped_scene = cv2.warpPerspective(frame_undistorted, M, (w_ref, h_ref))
-                            # Apply scene camera opacity
-                            cv2.addWeighted(warped_scene, self.scene_opacity,
-                                            self.ref_image_display, 1 - self.scene_opacity, 0, self.ref_image_display)
-
-                        # Apply heatmap if enabled
-                        if self.heatmap_checkbox.isChecked() and len(self.gaze_history) > 0:
-                            heatmap = np.zeros((config.ref_image.shape[0], config.ref_image.shape[1]), dtype=np.float32)
-                            for point in self.gaze_history:
-                                cv2.circle(heatmap, point, self.gaze_point_size, 1, -1)
-                            heatmap = cv2.GaussianBlur(heatmap, (0, 0), sigmaX=15, sigmaY=15)
-                            heatmap = cv2.normalize(heatmap, None, 0, 255, cv2.NORM_MINMAX)
-                            heatmap_color = cv2.applyColorMap(heatmap.astype(np.uint8), cv2.COLORMAP_JET)
-
-                            # Create alpha mask based on intensity
-                            alpha_mask = heatmap / 255.0 * self.heatmap_opacity
-                            alpha_mask = cv2.merge([alpha_mask, alpha_mask, alpha_mask])
-
-                            # Apply heatmap
-                            self.ref_image_display = self.ref_image_display.astype(np.float32) / 255.0
-                            heatmap_color = heatmap_color.astype(np.float32) / 255.0
-                            self.ref_image_display = (1 - alpha_mask) * self.ref_image_display + alpha_mask * heatmap_color
-                            self.ref_image_display = (self.ref_image_display * 255).astype(np.uint8)
-
-                        # Apply gaze point opacity
-                        overlay = self.ref_image_display.copy()
-                        color = (*self.gaze_point_color,)
-                        cv2.circle(overlay, (int(x_ref), int(y_ref)),
-                                self.gaze_point_size, color, -1)
-                        cv2.addWeighted(overlay, self.gaze_point_opacity,
-                                        self.ref_image_display, 1 - self.gaze_point_opacity, 0, self.ref_image_display)
-
-                        # Hold current system time
-                        self.current_system_time = parse_system_time(system_time_str)
-
-                        # AOI processing
-                        gaze_aoi_name = ''
-                        for aoi in self.aoi_list:
-                            # Get AOI rectangle
-                            rect = aoi.rect
-                            # Check if gaze is inside AOI
-                            gaze_inside = rect.contains(QPointF(x_ref, y_ref))
-
-                            if gaze_inside:
-                                if not aoi.is_gaze_inside:
-                                    # Gaze entered AOI
-                                    aoi.hit_count += 1
-                                    aoi.entry_time = self.current_system_time
-                                aoi.is_gaze_inside = True
-                                gaze_aoi_name = aoi.name
-                            else:
-                                if aoi.is_gaze_inside:
-                                    # Gaze exited AOI
-                                    if aoi.entry_time is not None:
-                                        aoi.dwell_time += self.current_system_time - aoi.entry_time
-                                        aoi.entry_time = None
-                                aoi.is_gaze_inside = False
-
-                            # Draw AOI
-                            rect_top_left = (int(rect.left()), int(rect.top()))
-                            rect_bottom_right = (int(rect.right()), int(rect.bottom()))
-                            if aoi.is_gaze_inside:
-                                # Gaze is inside AOI (red color)
-                                rect_color = (0, 0, 255)
-                            else:
-                                # Default color (green)
-                                rect_color = (0, 255, 0)
-                            cv2.rectangle(self.ref_image_display, rect_top_left, rect_bottom_right, rect_color, 1)
-
-                            # Display hit count or name on AOI
-                            if aoi.name:
-                                display_text = f'{aoi.name}: {aoi.hit_count}'
-                            else:
-                                display_text = f'{self.tr("無名")}: {aoi.hit_count}'
-                            text_size, baseline = cv2.getTextSize(display_text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)
-                            text_x = rect_top_left[0]
-                            text_y = rect_top_left[1] - 5
-                            if text_y < 0:
-                                text_y = rect_bottom_right[1] + text_size[1] + 5
-                            cv2.putText(self.ref_image_display, display_text, (text_x, text_y),
-                                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, rect_color, 1)
-
-                        # Update statistics
-                        self.update_statistics()
-
-                        # If drawing AOI and preview is enabled
-                        if self.drawing_aoi and draw_aoi_preview:
-                            start = self.aoi_start_point
-                            end = self.aoi_end_point
-                            # Scale coordinates to reference image
-                            pixmap = self.image_label.pixmap()
-                            if pixmap:
-                                label_rect = self.image_label.contentsRect()
-                                label_width = label_rect.width()
-                                label_height = label_rect.height()
-                                pixmap_width = pixmap.width()
-                                pixmap_height = pixmap.height()
-                                scaled_w = pixmap_width * min(
-                                    label_width / pixmap_width, label_height / pixmap_height)
-                                scaled_h = pixmap_height * min(
-                                    label_width / pixmap_width, label_height / pixmap_height)
-                                offset_x = (label_width - scaled_w) / 2
-                                offset_y = (label_height - scaled_h) / 2
-                                scale_x = pixmap_width / scaled_w
-                                scale_y = pixmap_height / scaled_h
-                                start_x = (start.x() - offset_x) * scale_x
-                                start_y = (start.y() - offset_y) * scale_y
-                                end_x = (end.x() - offset_x) * scale_x
-                                end_y = (end.y() - offset_y) * scale_y
-                                cv2.rectangle(self.ref_image_display, (int(start_x), int(start_y)),
-                                            (int(end_x), int(end_y)), (255, 0, 0), 1)
-
-                        # Calculate FPS
-                        current_time = time.time()
-                        self.fps = 1 / (current_time - self.previous_time)
-                        self.previous_time = current_time
-
-                        # Display FPS if enabled
-                        if self.show_fps:
-                            fps_text = f"FPS: {self.fps:.2f}"
-                            cv2.putText(self.ref_image_display, fps_text, (10, 30),
-                                        cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
-
-                        # Display image
-                        self.display_image(self.ref_image_display)
-
-                        # Update graph data
-                        current_time = self.current_system_time
-                        self.graph_time.append(current_time)
-                        self.graph_data_right.append(score_right)
-                        self.graph_data_left.append(score_left)
-
-                        # Limit buffer size
-                        max_points = 100  # Maximum number of points to display
-                        if len(self.graph_time) > max_points:
-                            self.graph_time = self.graph_time[-max_points:]
-                            self.graph_data_right = self.graph_data_right[-max_points:]
-                            self.graph_data_left = self.graph_data_left[-max_points:]
-
-                        # Update graph plots
-                        self.score_right_line.setData(self.graph_time, self.graph_data_right)
-                        self.score_left_line.setData(self.graph_time, self.graph_data_left)
-
-                        # If recording is active, record data
-                        if self.is_recording:
-                            self.frame_counter += 1
-                            data = {
-                                'Frame': self.frame_counter,
-                                'PicNum': pic_num,
-                                'GazeX': x_ref,
-                                'GazeY': y_ref,
-                                'AOI': gaze_aoi_name,
-                                'ScoreRight': score_right,
-                                'ScoreLeft': score_left,
-                                'SystemTime': system_time_str
-                            }
-                            self.recorded_data.append(data)
-                    else:
-                        # If homography could not be computed
-                        pass
-                else:
-                    # Not enough good matches
-                    pass
+        if self.display_buffer is None or self.display_buffer.shape != self.base_image.shape:
+            self.display_buffer = np.empty_like(self.base_image)
+        np.copyto(self.display_buffer, self.base_image)
+        self.ref_image_display = self.display_buffer
+        h_ref, w_ref = self.ref_image_display.shape[:2]
+        x_ref, y_ref = self.gaze_ref
+
+        # Apply heatmap if enabled
+        if self.heatmap_checkbox.isChecked() and self.gaze_count > 0:
+            self.apply_heatmap()
+
+        # Apply gaze point opacity inside the circle's bounding box only
+        if self.gaze_sprite is None:
+            self.gaze_sprite = self.build_gaze_sprite()
+        sprite, sprite_mask = self.gaze_sprite
+        r = self.gaze_point_size
+        xr, yr = int(x_ref), int(y_ref)
+        x0, y0 = max(0, xr - r), max(0, yr - r)
+        x1, y1 = min(w_ref, xr + r + 1), min(h_ref, yr + r + 1)
+        if x0 < x1 and y0 < y1:
+            roi = self.ref_image_display[y0:y1, x0:x1]
+            # Part of the sprite that lies inside the image
+            sx0, sy0 = x0 - (xr - r), y0 - (yr - r)
+            covered = sprite_mask[sy0:sy0 + y1 - y0, sx0:sx0 + x1 - x0]
+            color = sprite[sy0:sy0 + y1 - y0, sx0:sx0 + x1 - x0][covered]
+            if self.gaze_point_opacity >= 1.0:
+                roi[covered] = color
+            elif len(color) > 0:
+                roi[covered] = cv2.addWeighted(
+                    color, self.gaze_point_opacity, roi[covered], 1 - self.gaze_point_opacity, 0)
+
+        # Draw AOIs: the outlines as one corner array, rebuilt only when AOIs are added or removed
+        if self.aoi_corner_owners != self.aoi_list:
+            self.aoi_corner_owners = list(self.aoi_list)
+            bboxes = np.array([aoi.top_left + aoi.bottom_right for aoi in self.aoi_list], dtype=np.int32).reshape(-1, 4)
+            self.aoi_corners = bboxes[:, [0, 1, 2, 1, 2, 3, 0, 3]].reshape(-1, 4, 2)
+        gaze_inside = np.zeros(len(self.aoi_list), dtype=bool)
+        for i, aoi in enumerate(self.aoi_list):
+            rect_top_left = aoi.top_left
+            rect_bottom_right = aoi.bottom_right
+            if aoi.is_gaze_inside:
+                # Gaze is inside AOI (red color)
+                rect_color = (0, 0, 255)
+                gaze_inside[i] = True
+            else:
+                # Default color (green)
+                rect_color = (0, 255, 0)
+
+            # Display hit count or name on AOI
+            if aoi.name:
+                display_text = f'{aoi.name}: {aoi.hit_count}'
+            else:
+                display_text = f'{self.tr("無名")}: {aoi.hit_count}'
+            text_size, baseline = cv2.getTextSize(display_text, cv2.FONT_HERSHEY_SIMPLEX, 0.6, 1)
+            text_x = rect_top_left[0]
+            text_y = rect_top_left[1] - 5
+            if text_y < 0:
+                text_y = rect_bottom_right[1] + text_size[1] + 5
+            cv2.putText(self.ref_image_display, display_text, (text_x, text_y),
+                        cv2.FONT_HERSHEY_SIMPLEX, 0.6, rect_color, 1)
+        # One polylines call per color instead of a rectangle call per AOI
+        cv2.polylines(self.ref_image_display, self.aoi_corners[~gaze_inside], True, (0, 255, 0), 1)
+        cv2.polylines(self.ref_image_display, self.aoi_corners[gaze_inside], True, (0, 0, 255), 1)
+
+        # If drawing AOI and preview is enabled
+        if self.drawing_aoi and draw_aoi_preview:
+            start = self.aoi_start_point
+            end = self.aoi_end_point
+            # Scale coordinates to reference image
+            mapping = self.label_to_image_mapping()
+            if mapping:
+                offset_x, offset_y, scale_x, scale_y = mapping
+                start_x = (start.x() - offset_x) * scale_x
+                start_y = (start.y() - offset_y) * scale_y
+                end_x = (end.x() - offset_x) * scale_x
+                end_y = (end.y() - offset_y) * scale_y
+                cv2.rectangle(self.ref_image_display, (int(start_x), int(start_y)),
+                            (int(end_x), int(end_y)), (255, 0, 0), 1)
+
+        # Display FPS if enabled
+        if self.show_fps:
+            fps_text = f"FPS: {self.fps:.2f}"
+            cv2.putText(self.ref_image_display, fps_text, (10, 30),
+                        cv2.FONT_HERSHEY_SIMPLEX, 1, (255, 255, 255), 2)
+
+        # Display image
+        self.display_image(self.ref_image_display)
 
     def display_image(self, img):
-        # Convert BGR to RGB
-        img_rgb = cv2.cvtColor(img, cv2.COLOR_BGR2RGB)
-        h, w, ch = img_rgb.shape
-        bytes_per_line = ch * w
-        qt_image = QImage(img_rgb.data, w, h, bytes_per_line, QImage.Format_RGB888)
-        pixmap = QPixmap.fromImage(qt_image)
+        h, w, ch = img.shape
+        if hasattr(QImage, 'Format_BGR888'):
+            # Qt 5.14 and later read BGR directly; rows may be padded, pixels must be packed
+            if img.strides[1:] != (ch, 1):
+                img = np.ascontiguousarray(img)
+            qt_image = QImage(img.data, w, h, img.strides[0], QImage.Format_BGR888)
+        else:
+            # Convert BGR to RGB into a reusable buffer
+            if self.rgb_buffer is None or self.rgb_buffer.shape != img.shape:
+                self.rgb_buffer = np.empty_like(img)
+            cv2.cvtColor(img, cv2.COLOR_BGR2RGB, dst=self.rgb_buffer)
+            qt_image = QImage(self.rgb_buffer.data, w, h, self.rgb_buffer.strides[0], QImage.Format_RGB888)
+        # convertFromImage copies the pixels, so the numpy buffer may be reused afterwards. The label
+        # holds a shallow copy of the pixmap shown last, so the other one is written without detaching.
+        pixmap = self.pixmaps[self.pixmap_index]
+        pixmap.convertFromImage(qt_image)
         self.image_label.setPixmap(pixmap)
+        self.pixmap_index = 1 - self.pixmap_index
+
+    def label_to_image_mapping(self):
+        # Offset and scale of the pixmap shown (aspect ratio kept, centered) in image_label;
+        # recomputed only when the label or pixmap size changes
+        pixmap = self.image_label.pixmap()
+        if not pixmap:
+            return None
+        label_rect = self.image_label.contentsRect()
+        key = (label_rect.width(), label_rect.height(), pixmap.width(), pixmap.height())
+        if key != self.label_mapping_key:
+            label_width, label_height, pixmap_width, pixmap_height = key
+            scale = min(label_width / pixmap_width, label_height / pixmap_height)
+            scaled_w = pixmap_width * scale
+            scaled_h = pixmap_height * scale
+            offset_x = (label_width - scaled_w) / 2
+            offset_y = (label_height - scaled_h) / 2
+            self.label_mapping = (offset_x, offset_y, pixmap_width / scaled_w, pixmap_height / scaled_h)
+            self.label_mapping_key = key
+        return self.label_mapping
 
     def resizeEvent(self, event):
         # Update AOI preview when window size changes
@@ -1242,6 +1338,7 @@ class GazeApp(QMainWindow):
 
 # Main function to run the application
 def main():
+    configure_opencv()
     app = QApplication(sys.argv)
     gaze_app = GazeApp()
     gaze_app.show()
@@ -0,0 +1,348 @@
+# processor.py
+
+"""
+This module runs the image processing pipeline in a separate thread, so that undistortion,
+feature matching and warping do not block the GUI.
+
+Functions:
+- load_reference(image_path, comm): Loads the reference image and computes its ORB features.
+- match_features(frame_gray, w, h, scale): ORB keypoints of a frame matched against the reference keypoints.
+- estimate_homography(frame_pts, ref_pts, scale, keypoint_undistortion): Frame to reference homography of matched points.
+- track_points(previous_gray, frame_gray, previous_pts, ref_pts): Follows matched points into the next frame (optical flow).
+- process_frames(comm, stop_event): Matches received frames against the reference image and emits the results.
+
+Data Sent:
+- comm: Communicate object whose frame_processed signal receives the results.
+- stop_event: threading.Event that ends the processing loop when set.
+- image_path: Path of the reference image.
+
+Data Returned:
+- Emits a dict for every frame whose homography could be computed:
+  'image' (reference sized base image: the reference image or the blended scene overlay),
+  'gaze_ref' (gaze point in reference image coordinates) and the data received with the frame
+  ('pic_num', 'score_right', 'score_left', 'system_time' and 'timestamp', system_time as a float).
+  With the scene overlay 'image' is one of two output buffers, reused by the next overlay result once
+  config.result_consumed has been set by the receiver of the signal; without it 'image' is config.ref_image itself.
+- load_reference emits a dict through comm.reference_loaded: 'ref_image', 'ref_gray', 'ref_keypoints' and
+  'ref_descriptors', or 'error' ('read' or 'features') if the image could not be used.
+"""
+
+import logging
+import numpy as np
+import cv2
+
+from utils import precompute_undistort_map, remap_frame, remap_frame_gpu, upload_undistort_map, \
+    page_locked_buffer, opencl_available
+from kernels import blend_images
+import config
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = (64, 64)
+USE_MAGSAC = hasattr(cv2, 'USAC_MAGSAC')
+# Fewest optical flow points a tracked homography is computed from; below that ORB matching is run
+TRACK_MIN_POINTS = 20
+
+def load_reference(image_path, comm):
+    # Runs in a worker thread, so loading a large reference image does not block the GUI
+    ref_image = cv2.imread(image_path)
+    if ref_image is None:
+        comm.reference_loaded.emit({'error': 'read'})
+        return
+    # Separate detector, the processing thread of the previous settings may still be using config.orb
+    if config.ref_orb is None:
+        config.ref_orb = cv2.ORB_create(**config.orb_params)
+    # The grayscale copy is made once here and never converted again per frame
+    ref_gray = cv2.cvtColor(ref_image, cv2.COLOR_BGR2GRAY)
+    # With an OpenCL device FAST and the descriptors run through the T-API; the keypoints and
+    # descriptors are brought back to the host since they are matched on the CPU as well
+    ref_keypoints, ref_descriptors = config.ref_orb.detectAndCompute(
+        cv2.UMat(ref_gray) if opencl_available() else ref_gray, None)
+    if isinstance(ref_descriptors, cv2.UMat):
+        ref_descriptors = ref_descriptors.get()
+    if ref_descriptors is None or len(ref_descriptors) == 0:
+        comm.reference_loaded.emit({'error': 'features'})
+        return
+    comm.reference_loaded.emit({
+        'ref_image': np.ascontiguousarray(ref_image),
+        'ref_gray': ref_gray,
+        'ref_keypoints': ref_keypoints,
+        # Contiguous uint8 array, matched against every frame
+        'ref_descriptors': np.ascontiguousarray(ref_descriptors, dtype=np.uint8)
+    })
+
+def match_features(frame_gray, w, h, scale):
+    # Compute keypoints and descriptors on a copy downscaled by scale and match them against
+    # the reference; returns the matched (frame points at that scale, reference points) or None
+    if config.use_cuda:
+        if scale != 1.0:
+            frame_gray = cv2.cuda.resize(frame_gray, (int(w * scale), int(h * scale)),
+                                         interpolation=cv2.INTER_AREA, stream=config.cuda_stream)
+        frame_keypoints_gpu, frame_descriptors_gpu = config.cuda_orb.detectAndComputeAsync(
+            frame_gray, None, stream=config.cuda_stream)
+        config.cuda_stream.waitForCompletion()
+        if frame_descriptors_gpu.empty():
+            return None
+        frame_keypoints = config.cuda_orb.convert(frame_keypoints_gpu)
+        matches = config.cuda_matcher.knnMatch(config.ref_descriptors_gpu, frame_descriptors_gpu, k=2)
+        good_matches = None
+    else:
+        if scale != 1.0:
+            frame_gray = cv2.resize(frame_gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+        frame_keypoints, frame_descriptors = config.orb.detectAndCompute(frame_gray, None)
+        if isinstance(frame_descriptors, cv2.UMat):
+            frame_descriptors = frame_descriptors.get()
+        if frame_descriptors is None or len(frame_descriptors) == 0:
+            return None
+        if config.cross_check:
+            # Mutual nearest neighbours in a single match pass, without the ratio test
+            matches = config.cross_check_matcher.match(config.ref_descriptors, frame_descriptors)
+            good_matches = np.array([(m.queryIdx, m.trainIdx) for m in matches], dtype=np.intp).reshape(-1, 2)
+        else:
+            matches = config.matcher.knnMatch(config.ref_descriptors, frame_descriptors, k=2)
+            good_matches = None
+
+    if good_matches is None:
+        # Apply ratio test to all (best, second best) pairs at once; the columns are
+        # best distance, second best distance, query index and train index
+        match_data = np.array([(m_n[0].distance, m_n[1].distance, m_n[0].queryIdx, m_n[0].trainIdx)
+                               for m_n in matches if len(m_n) == 2], dtype=np.float32).reshape(-1, 4)
+        good_matches = match_data[match_data[:, 0] < 0.75 * match_data[:, 1], 2:].astype(np.intp)
+
+    if len(good_matches) <= 10:
+        # Not enough good matches
+        return None
+
+    # good_matches holds (reference keypoint index, frame keypoint index) rows
+    frame_pts = cv2.KeyPoint_convert(frame_keypoints)[good_matches[:, 1]].reshape(-1, 1, 2)
+    ref_pts = config.ref_pts[good_matches[:, 0]].reshape(-1, 1, 2)
+    return frame_pts, ref_pts
+
+def estimate_homography(frame_pts, ref_pts, scale, keypoint_undistortion=None):
+    # Frame to reference homography from point pairs whose frame points are at the given scale
+    # (scaled back to the resolution of the frame here); returns (M, inlier mask), M is None if
+    # it could not be computed
+    dst_pts = frame_pts / scale if scale != 1.0 else frame_pts
+    if keypoint_undistortion is not None:
+        # Keypoints of a distorted frame are moved into the cropped undistorted frame
+        camera_matrix, dist_coeffs, projection = keypoint_undistortion
+        dst_pts = cv2.undistortPoints(dst_pts, camera_matrix, dist_coeffs, P=projection)
+
+    # MAGSAC++ converges in fewer iterations than classic RANSAC, which remains the fallback for OpenCV < 4.5
+    if USE_MAGSAC:
+        return cv2.findHomography(dst_pts, ref_pts, cv2.USAC_MAGSAC, 3.0, maxIters=500, confidence=0.99)
+    return cv2.findHomography(dst_pts, ref_pts, cv2.RANSAC, 5.0)
+
+def track_points(previous_gray, frame_gray, previous_pts, ref_pts):
+    # Follow the inlier points of the previous homography into the current frame with pyramidal
+    # Lucas-Kanade optical flow; returns the tracked (frame points, reference points) or None
+    if previous_gray.shape != frame_gray.shape:
+        return None
+    frame_pts, status, _ = cv2.calcOpticalFlowPyrLK(previous_gray, frame_gray, previous_pts, None,
+                                                    winSize=(21, 21), maxLevel=3)
+    tracked = status.ravel() == 1
+    if np.count_nonzero(tracked) < TRACK_MIN_POINTS:
+        return None
+    return frame_pts[tracked], ref_pts[tracked]
+
+def process_frames(comm, stop_event):
+    previous_frame_shape = None
+    previous_latest = None
+    # Thumbnail of the frame the current homography was computed on
+    key_thumbnail = None
+    key_M = None
+    # Detection scale grayscale frame and inlier (frame, reference) points of the last homography,
+    # followed with optical flow for up to config.track_refresh_frames frames between ORB matches
+    key_gray = None
+    key_points = None
+    tracked_frames = 0
+    undistort_buffer = None
+    warp_buffer = np.empty_like(config.ref_image)
+    # Two output buffers: one may still be copied by the GUI while the other is written
+    output_buffers = [np.empty_like(config.ref_image), np.empty_like(config.ref_image)]
+    output_index = 0
+    h_ref, w_ref = config.ref_image.shape[:2]
+    config.result_consumed.set()
+
+    while not stop_event.is_set():
+        if not config.frame_available.wait(0.1):
+            continue
+        config.frame_available.clear()
+
+        try:
+            # Read the latest frame once; the receiver publishes a new tuple for every message
+            latest = config.latest_frame[0]
+            if latest is None or latest is previous_latest:
+                continue
+            previous_latest = latest
+            frame_proc, gaze_x, gaze_y, pic_num, score_right, score_left, system_time_str, timestamp, \
+                frame_scale = latest
+
+            # Look up the undistortion map only when the frame size or decode scale changes
+            # (maps of previously seen sizes come from the cache in precompute_undistort_map)
+            if previous_frame_shape != (frame_proc.shape[:2], frame_scale):
+                # Intrinsics of frames decoded at reduced size
+                camera_matrix_frame = config.camera_matrix.copy()
+                camera_matrix_frame[:2] *= frame_scale
+                map1_frame, map2_frame, roi_frame, new_camera_mtx_frame = precompute_undistort_map(
+                    frame_proc.shape, camera_matrix_frame, config.dist_coeffs)
+                if config.use_cuda:
+                    config.map1_gpu, config.map2_gpu = upload_undistort_map(map1_frame, map2_frame)
+                    config.frame_pinned = page_locked_buffer(frame_proc.shape, config.frame_pinned)
+                elif config.use_opencl and map1_frame is not None:
+                    # Keep the fixed-point maps on the OpenCL device instead of uploading them with every remap
+                    map1_frame, map2_frame = cv2.UMat(map1_frame), cv2.UMat(map2_frame)
+                undistort_buffer = np.empty((roi_frame[3], roi_frame[2]) + frame_proc.shape[2:], np.uint8)
+                # Maps normalized undistorted points to pixels of the cropped undistorted frame
+                crop_x, crop_y = roi_frame[:2]
+                crop_projection = np.array(
+                    [[1, 0, -crop_x], [0, 1, -crop_y], [0, 0, 1]], np.float64) @ new_camera_mtx_frame
+                previous_frame_shape = (frame_proc.shape[:2], frame_scale)
+
+            # Scale gaze coordinates to image size
+            h_frame, w_frame = frame_proc.shape[:2]
+            gaze_x = gaze_x * w_frame
+            gaze_y = gaze_y * h_frame
+
+            # The whole frame is undistorted only for the scene overlay (or if config.remap_frames is set).
+            # Otherwise features are detected on the distorted frame and only the matched keypoints are
+            # undistorted; the homography maps the cropped undistorted frame to the reference either way
+            # (the maps only cover roi_frame, so remap writes the cropped frame directly).
+            overlay_scene = config.overlay_settings['overlay_scene']
+            w, h = roi_frame[2:]
+            if overlay_scene or (config.remap_frames and config.use_cuda):
+                # Undistort the frame (on the GPU the result stays in device memory)
+                if config.use_cuda:
+                    np.copyto(config.frame_pinned, frame_proc)
+                    config.frame_gpu.upload(config.frame_pinned, config.cuda_stream)
+                    frame_undistorted_gpu = remap_frame_gpu(config.frame_gpu, config.map1_gpu, config.map2_gpu,
+                                                            config.undistorted_gpu, config.cuda_stream)
+                    frame_source_gpu = frame_undistorted_gpu
+                elif config.use_opencl:
+                    # remap, cvtColor, resize, ORB and warpPerspective run on the OpenCL device
+                    frame_undistorted = remap_frame(cv2.UMat(frame_proc), map1_frame, map2_frame)
+                else:
+                    frame_undistorted = remap_frame(frame_proc, map1_frame, map2_frame, dst=undistort_buffer)
+                frame_source = frame_undistorted
+                detect_w, detect_h = w, h
+                keypoint_undistortion = None
+            elif config.remap_frames:
+                # Without the overlay only the grayscale frame is used, so it is converted first and
+                # the remap moves one channel instead of three
+                frame_gray = cv2.cvtColor(cv2.UMat(frame_proc) if config.use_opencl else frame_proc, cv2.COLOR_BGR2GRAY)
+                # (a new image each frame: the tracked key frame may still refer to the previous one)
+                frame_gray = remap_frame(frame_gray, map1_frame, map2_frame)
+                frame_source = None
+                detect_w, detect_h = w, h
+                keypoint_undistortion = None
+            else:
+                if config.use_cuda:
+                    np.copyto(config.frame_pinned, frame_proc)
+                    config.frame_gpu.upload(config.frame_pinned, config.cuda_stream)
+                    frame_source_gpu = config.frame_gpu
+                else:
+                    frame_source = cv2.UMat(frame_proc) if config.use_opencl else frame_proc
+                detect_w, detect_h = w_frame, h_frame
+                keypoint_undistortion = (camera_matrix_frame, config.dist_coeffs, crop_projection)
+
+            # Convert frame to grayscale and take a small thumbnail to detect scene motion
+            if config.use_cuda:
+                frame_gray = cv2.cuda.cvtColor(frame_source_gpu, cv2.COLOR_BGR2GRAY,
+                                               stream=config.cuda_stream)
+                thumbnail_gpu = cv2.cuda.resize(frame_gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA,
+                                                stream=config.cuda_stream)
+                config.cuda_stream.waitForCompletion()
+                thumbnail = thumbnail_gpu.download()
+            else:
+                if frame_source is not None:
+                    frame_gray = cv2.cvtColor(frame_source, cv2.COLOR_BGR2GRAY)
+                thumbnail = cv2.resize(frame_gray, THUMBNAIL_SIZE, interpolation=cv2.INTER_AREA)
+                if config.use_opencl:
+                    thumbnail = thumbnail.get()
+
+            # Reuse the last homography while the scene has not moved since it was computed
+            if key_thumbnail is not None and \
+                    cv2.norm(thumbnail, key_thumbnail, cv2.NORM_L1) < config.motion_threshold * thumbnail.size:
+                M = key_M
+            else:
+                # detection_scale is relative to the sent image, part of it may already be done by the decoder
+                scale = min(1.0, config.detection_scale / frame_scale)
+                M = None
+                if config.use_cuda:
+                    matched = match_features(frame_gray, detect_w, detect_h, scale)
+                    if matched is not None:
+                        M, inliers = estimate_homography(*matched, scale, keypoint_undistortion)
+                else:
+                    # Downscale once; ORB and the optical flow both work on this image
+                    if scale != 1.0:
+                        frame_gray = cv2.resize(frame_gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+                    track_gray = frame_gray.get() if config.use_opencl else frame_gray
+                    if key_points is not None and tracked_frames < config.track_refresh_frames:
+                        matched = track_points(key_gray, track_gray, *key_points)
+                        if matched is not None:
+                            M, inliers = estimate_homography(*matched, scale, keypoint_undistortion)
+                            tracked_frames += 1
+                    if M is None:
+                        # Tracking lost, due for a refresh or nothing to track yet
+                        matched = match_features(frame_gray, detect_w, detect_h, 1.0)
+                        tracked_frames = 0
+                        if matched is not None:
+                            M, inliers = estimate_homography(*matched, scale, keypoint_undistortion)
+                    if M is not None:
+                        inliers = inliers.ravel() == 1
+                        key_gray, key_points = track_gray, (matched[0][inliers], matched[1][inliers])
+                if M is None:
+                    key_thumbnail = key_points = None
+                    continue
+                key_thumbnail, key_M = thumbnail, M
+
+            # Undistort the gaze point to normalized camera coordinates, then project it into the
+            # reference image with one 3x3 product (new camera matrix, crop offset and homography)
+            gaze_point = np.array([[[gaze_x, gaze_y]]], dtype=np.float32)
+            gaze_x_n, gaze_y_n = cv2.undistortPoints(gaze_point, camera_matrix_frame, config.dist_coeffs)[0, 0]
+            gaze_point_ref = M @ crop_projection @ (gaze_x_n, gaze_y_n, 1.0)
+            x_ref, y_ref = (gaze_point_ref[:2] / gaze_point_ref[2]).astype(np.float32)
+
+            # Overlay scene camera if enabled
+            scene_opacity = config.overlay_settings['scene_opacity']
+            if not overlay_scene:
+                # The reference image is never written, so it is handed over without a copy
+                output = config.ref_image
+            else:
+                output = output_buffers[output_index]
+                output_index = 1 - output_index
+                if config.use_cuda:
+                    # Warp and blend on the GPU, downloading only the composite
+                    cv2.cuda.warpPerspective(frame_undistorted_gpu, M, (w_ref, h_ref),
+                                             dst=config.warped_gpu, stream=config.cuda_stream)
+                    cv2.cuda.addWeighted(config.warped_gpu, scene_opacity,
+                                         config.ref_image_gpu, 1 - scene_opacity, 0,
+                                         dst=config.blended_gpu, stream=config.cuda_stream)
+                    config.blended_gpu.download(config.cuda_stream, output)
+                    config.cuda_stream.waitForCompletion()
+                elif config.use_opencl:
+                    warped_scene = cv2.warpPerspective(frame_undistorted, M, (w_ref, h_ref)).get()
+                    blend_images(warped_scene, config.ref_image, scene_opacity, output)
+                else:
+                    warped_scene = cv2.warpPerspective(frame_undistorted, M, (w_ref, h_ref), dst=warp_buffer)
+                    # Apply scene camera opacity, blending straight into the output buffer
+                    blend_images(warped_scene, config.ref_image, scene_opacity, output)
+
+            # Wait until the GUI has taken the previous result before handing over the next one
+            while not config.result_consumed.wait(0.1):
+                if stop_event.is_set():
+                    return
+            config.result_consumed.clear()
+            comm.frame_processed.emit({
+                'image': output,
+                'gaze_ref': (x_ref, y_ref),
+                'pic_num': pic_num,
+                'score_right': score_right,
+                'score_left': score_left,
+                'system_time': system_time_str,
+                'timestamp': timestamp
+            })
+        except cv2.error:
+            # A frame OpenCV cannot process (e.g. an unexpected size or format) is skipped instead
+            # of ending the thread
+            logger.exception('Frame could not be processed')
@@ -4,49 +4,249 @@
 This module handles receiving frames via ZeroMQ in a separate thread.
 
 Functions:
-- receive_frames(zmq_address): Receives frames and updates shared data.
+- receive_frames(zmq_address, stop_event): Receives frames and hands the latest message to the decoder thread.
+- decode_frames(pending, stop_event): Decodes queued messages and updates shared data.
+- attach_shared_memory(name): Opens a shared memory segment created by a local publisher.
+- read_shared_frame(shm, message): Copies a raw frame out of shared memory unless it was overwritten,
+  is not an (h, w, 3) frame or does not fit in the segment.
 
 Data Sent:
 - zmq_address: ZeroMQ address to connect to.
+- stop_event: threading.Event that ends the receiving loop when set.
+- pending: queue.Queue(maxsize=1) holding the latest undecoded message parts.
 
 Data Returned:
-- Updates shared_data in config.py with the latest frame and associated data.
+- Publishes the latest frame and associated data in config.latest_frame. Encoded images are
+  decoded at 1/config.decode_reduction of their size (JPEG DCT scaling); 'frame_scale' holds the
+  resulting scale relative to the sent image. JPEG frames are decoded with PyTurboJPEG if it is
+  installed and finds libjpeg-turbo, otherwise with cv2.imdecode.
+
+Message Formats:
+- Single part (legacy): a pickled dict with 'frame', 'gaze_x', 'gaze_y', 'score_right', 'score_left',
+  'system_time' and a base64 encoded JPEG in 'image'. 'image' may also hold the JPEG/PNG bytes
+  without base64, which skips the base64 decode.
+- Pickled and JSON metadata may also contain 'system_time_epoch', the send time as seconds since the
+  epoch (float). Without it the time is parsed from 'system_time'.
+- Two parts: JSON metadata with the same keys (without 'image'), followed by the image bytes.
+  If the metadata contains 'shape' ([h, w, 3]) the bytes are a raw BGR uint8 frame,
+  otherwise they are an encoded image (e.g. JPEG) without base64.
+- Two parts with a binary header instead of JSON, packed as HEADER_STRUCT (little endian):
+  frame (int32), gaze_x, gaze_y, score_right, score_left (float64), system_time (23 bytes ASCII)
+  and the frame shape h, w, c (int32). A shape of (0, 0, 0) means the image bytes are encoded.
+- Single part JSON (publisher on the same machine, e.g. tcp://localhost or ipc://): the metadata keys
+  plus 'shm' (shared memory segment name), 'shape' ([h, w, 3]) and 'shm_seq'. The segment holds a
+  little endian uint64 sequence number followed by the raw BGR frame. The publisher makes the sequence
+  number odd while writing and sets it to 'shm_seq' (even) afterwards; frames whose sequence number
+  changed while they were copied are dropped.
 """
 
 import zmq
 import base64
+import binascii
+import json
+import pickle
+import struct
+import queue
+import threading
+from multiprocessing import shared_memory, resource_tracker
 import cv2
 import numpy as np
-from config import frame_lock, frame_available, shared_data
+import config
+from config import latest_frame, frame_available
+from utils import parse_system_time
+
+HEADER_STRUCT = struct.Struct('<i4d23s3i')
+SHM_SEQ_STRUCT = struct.Struct('<Q')
+
+# Leading bytes of JPEG and PNG data, which never start base64 text
+IMAGE_SIGNATURES = (b'\xff\xd8', b'\x89PNG')
+
+# Use libjpeg-turbo through PyTurboJPEG for JPEG frames when it is installed
+try:
+    from turbojpeg import TurboJPEG, TJPF_BGR
+    turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError, OSError):
+    turbo_jpeg = None
+
+# imdecode flags for each supported decode reduction
+DECODE_FLAGS = {
+    1: cv2.IMREAD_COLOR,
+    2: cv2.IMREAD_REDUCED_COLOR_2,
+    4: cv2.IMREAD_REDUCED_COLOR_4,
+    8: cv2.IMREAD_REDUCED_COLOR_8
+}
 
-def receive_frames(zmq_address):
+def unpack_header(header):
+    # Convert a binary header into the same dict as the JSON metadata
+    frame_num, gaze_x, gaze_y, score_right, score_left, system_time, h, w, c = HEADER_STRUCT.unpack(header)
+    message = {'frame': frame_num, 'gaze_x': gaze_x, 'gaze_y': gaze_y,
+               'score_right': score_right, 'score_left': score_left,
+               'system_time': system_time.rstrip(b'\0').decode('ascii') or None}
+    if h > 0:
+        message['shape'] = (h, w, c)
+    return message
+
+def attach_shared_memory(name):
+    # The segment belongs to the publisher; do not let this process unlink it on exit
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # Python < 3.13 registers attached segments with the resource tracker
+        shm = shared_memory.SharedMemory(name=name)
+        resource_tracker.unregister(shm._name, 'shared_memory')
+        return shm
+
+def read_shared_frame(shm, message):
+    # Seqlock read: the frame is valid only if the sequence number matches the message
+    # before and after the copy
+    seq = message['shm_seq']
+    shape = tuple(message['shape'])
+    if len(shape) != 3 or shape[2] != 3 or SHM_SEQ_STRUCT.size + int(np.prod(shape)) > shm.size:
+        return None
+    if SHM_SEQ_STRUCT.unpack_from(shm.buf)[0] != seq:
+        return None
+    frame = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf, offset=SHM_SEQ_STRUCT.size).copy()
+    if SHM_SEQ_STRUCT.unpack_from(shm.buf)[0] != seq:
+        return None
+    return frame
+
+def receive_frames(zmq_address, stop_event):
     # ZeroMQ setup (as a subscriber)
     context = zmq.Context()
     socket = context.socket(zmq.SUB)
+    # Keep a single message queued; stale frames are dropped below anyway
+    # (zmq.CONFLATE would drop them in libzmq but does not support multipart messages)
+    socket.setsockopt(zmq.RCVHWM, 1)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.setsockopt(zmq.TCP_KEEPALIVE, 1)
     socket.connect(zmq_address)
     socket.setsockopt_string(zmq.SUBSCRIBE, "")
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+
+    # Decode in a second thread so receiving the next message overlaps with decoding
+    pending = queue.Queue(maxsize=1)
+    decode_thread = threading.Thread(target=decode_frames, args=(pending, stop_event))
+    decode_thread.daemon = True
+    decode_thread.start()
+
+    while not stop_event.is_set():
+        # Wait with a timeout so the thread can be stopped when settings are re-applied
+        if not poller.poll(100):
+            continue
+        parts = socket.recv_multipart(copy=False)
+        # Drop stale messages and decode only the most recent one
+        while socket.poll(0):
+            parts = socket.recv_multipart(copy=False)
+
+        # Replace a message the decoder has not started on yet
+        try:
+            pending.get_nowait()
+        except queue.Empty:
+            pass
+        pending.put(parts)
+
+    decode_thread.join()
+    socket.close(linger=0)
+
+def decode_frames(pending, stop_event):
+    # Shared memory segments attached so far, by name
+    segments = {}
+    while not stop_event.is_set():
+        try:
+            parts = pending.get(timeout=0.1)
+        except queue.Empty:
+            continue
+
+        frame_temp = None
+        if len(parts) == 1 and parts[0].buffer[:1] == b'{':
+            # Local publisher: metadata only, the frame is in shared memory
+            name = None
+            try:
+                message = json.loads(parts[0].bytes)
+                name = message['shm']
+                shm = segments.get(name)
+                if shm is None:
+                    shm = segments[name] = attach_shared_memory(name)
+                frame_temp = read_shared_frame(shm, message)
+            except (OSError, KeyError, TypeError, ValueError):
+                # Segment gone (e.g. the publisher restarted) or incomplete metadata; attach again next time
+                if isinstance(name, str) and name in segments:
+                    segments.pop(name).close()
+                continue
+            if frame_temp is None:
+                continue
+            frame_scale = 1.0
+        elif len(parts) == 1:
+            # Legacy message: pickled dict with base64 encoded (or plain) image bytes
+            try:
+                message = pickle.loads(parts[0].buffer)
+                image_bytes = message['image']
+                if isinstance(image_bytes, str) or not image_bytes.startswith(IMAGE_SIGNATURES):
+                    image_bytes = base64.b64decode(image_bytes)
+            except (pickle.UnpicklingError, EOFError, binascii.Error, KeyError, TypeError, ValueError):
+                # Truncated pickle or image data that is not valid base64
+                continue
+        else:
+            # Multipart message: JSON or binary metadata and image bytes
+            header = parts[0].bytes
+            if len(header) == HEADER_STRUCT.size and not header.startswith(b'{'):
+                message = unpack_header(header)
+            else:
+                message = json.loads(header)
+            image_bytes = parts[1].buffer
 
-    while True:
-        message = socket.recv_pyobj()
         frame_num = message['frame']
         gaze_x = message['gaze_x']
         gaze_y = message['gaze_y']
         score_right = message.get('score_right', 0)
         score_left = message.get('score_left', 0)
         system_time = message.get('system_time', None)
-        encoded_image = message['image']
-
-        # Decode image data
-        decoded_image = base64.b64decode(encoded_image)
-        np_image = np.frombuffer(decoded_image, dtype=np.uint8)
-        frame_temp = cv2.imdecode(np_image, cv2.IMREAD_COLOR)
-
-        with frame_lock:
-            shared_data['frame'] = frame_temp.copy()
-            shared_data['gaze_x'] = gaze_x
-            shared_data['gaze_y'] = gaze_y
-            shared_data['frame_num'] = frame_num  # Use as PicNum
-            shared_data['score_right'] = score_right
-            shared_data['score_left'] = score_left
-            shared_data['system_time'] = system_time
+        # Numeric time for dwell times and the graph, parsed here instead of in the GUI thread
+        timestamp = message.get('system_time_epoch')
+        if timestamp is None:
+            timestamp = parse_system_time(system_time)
+
+        # Decode image data (raw frames are wrapped without decoding or copying; the array
+        # keeps the received message alive). Each message yields a new array, so it is
+        # published by reference.
+        if frame_temp is None:
+            np_image = np.frombuffer(image_bytes, dtype=np.uint8)
+            if np_image.size == 0:
+                continue
+            if 'shape' in message:
+                try:
+                    shape = tuple(message['shape'])
+                    # Only BGR frames can be processed
+                    if len(shape) != 3 or shape[2] != 3:
+                        continue
+                    frame_temp = np_image.reshape(shape)
+                except (TypeError, ValueError):
+                    # Shape is not a list or does not match the payload size
+                    continue
+                frame_scale = 1.0
+            else:
+                if turbo_jpeg is not None and np_image[:2].tobytes() == IMAGE_SIGNATURES[0]:
+                    try:
+                        frame_temp = turbo_jpeg.decode(np_image, pixel_format=TJPF_BGR,
+                                                       scaling_factor=(1, config.decode_reduction))
+                    except OSError:
+                        # libjpeg-turbo rejects the data; imdecode returns what it can (or None)
+                        frame_temp = None
+                if frame_temp is None:
+                    try:
+                        frame_temp = cv2.imdecode(np_image, DECODE_FLAGS[config.decode_reduction])
+                    except cv2.error:
+                        continue
+                frame_scale = 1.0 / config.decode_reduction
+            if frame_temp is None:
+                # Corrupt or truncated image, keep the last published frame
+                continue
+
+        # frame_num is used as PicNum
+        latest_frame[0] = (frame_temp, gaze_x, gaze_y, frame_num, score_right, score_left, system_time, timestamp,
+                          frame_scale)
         frame_available.set()
+
+    for shm in segments.values():
+        shm.close()
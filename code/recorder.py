@@ -0,0 +1,92 @@
+# recorder.py
+
+"""
+This module streams recorded gaze samples to a CSV file in chunks.
+
+Classes:
+- GazeRecorder: Collects rows (gaze coordinates in preallocated NumPy columns) and writes them to the open file
+  whenever chunk_size rows have been recorded.
+
+Data Sent:
+- open(filename): Path of the CSV file to create; the header row is written immediately.
+- append(pic_num, gaze_x, gaze_y, aoi_name, score_right, score_left, system_time): One recorded sample.
+- close(): Writes the remaining rows and closes the file.
+
+Data Returned:
+- A CSV file with the columns in GazeRecorder.FIELDNAMES; 'Frame' counts the recorded samples from 1.
+"""
+
+import csv
+import numpy as np
+
+class GazeRecorder:
+    FIELDNAMES = ['Frame', 'PicNum', 'GazeX', 'GazeY', 'AOI', 'ScoreRight', 'ScoreLeft', 'SystemTime']
+
+    def __init__(self, chunk_size=4096):
+        self.chunk_size = chunk_size
+        self.file = None
+        self.writer = None
+        self.gaze_x = np.empty(chunk_size, np.float32)
+        self.gaze_y = np.empty(chunk_size, np.float32)
+        # PicNum, AOI names, scores and system time strings are kept as sent, so they are written
+        # exactly as the values received (an integer score stays an integer)
+        self.pic_num = []
+        self.aoi_names = []
+        self.score_right = []
+        self.score_left = []
+        self.system_times = []
+        self.count = 0  # Rows in the current chunk
+        self.written = 0  # Rows already written to the file
+
+    def __len__(self):
+        return self.written + self.count
+
+    def open(self, filename):
+        # A large write buffer, the rows arrive in chunks anyway
+        self.file = open(filename, 'w', newline='', encoding='utf-8', buffering=1 << 20)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(self.FIELDNAMES)
+        self.pic_num.clear()
+        self.aoi_names.clear()
+        self.score_right.clear()
+        self.score_left.clear()
+        self.system_times.clear()
+        self.count = 0
+        self.written = 0
+
+    def append(self, pic_num, gaze_x, gaze_y, aoi_name, score_right, score_left, system_time):
+        i = self.count
+        self.gaze_x[i] = gaze_x
+        self.gaze_y[i] = gaze_y
+        self.pic_num.append(pic_num)
+        self.aoi_names.append(aoi_name)
+        self.score_right.append(score_right)
+        self.score_left.append(score_left)
+        self.system_times.append(system_time)
+        self.count += 1
+        if self.count == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        # Write the current chunk with one writerows call; frame numbers are implicit
+        n = self.count
+        rows = zip(range(self.written + 1, self.written + n + 1), self.pic_num, self.gaze_x[:n], self.gaze_y[:n],
+                   self.aoi_names, self.score_right, self.score_left, self.system_times)
+        self.writer.writerows(rows)
+        self.pic_num.clear()
+        self.aoi_names.clear()
+        self.score_right.clear()
+        self.score_left.clear()
+        self.system_times.clear()
+        self.written += n
+        self.count = 0
+
+    def close(self):
+        if self.file is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.file.close()
+            self.file = None
+            self.writer = None
@@ -4,18 +4,49 @@
 This module provides utility functions used across the application.
 
 Functions:
-- precompute_undistort_map(image_shape): Precomputes the undistortion map for a given image shape.
+- precompute_undistort_map(image_shape, camera_matrix, dist_coeffs): Returns the undistortion map for a given image shape,
+  cached for the last few (shape, camera matrix, distortion) combinations.
+- build_undistort_map(h, w, camera_matrix_bytes, dist_coeffs_bytes): Cached map computation used by precompute_undistort_map.
+- remap_frame(img, map1, map2, dst=None): Undistorts and crops an image with the fixed-point maps, writing into dst if given.
 - parse_system_time(system_time_str): Parses a system time string into a timestamp.
+- hour_start_timestamp(year, month, day, hour): Cached timestamp of a local hour, used by parse_system_time.
+- cuda_available(): Checks whether OpenCV was built with CUDA and a device is present.
+- opencl_available(): Enables OpenCV's OpenCL (T-API) paths if an OpenCL device is present.
+- upload_undistort_map(map1, map2): Uploads the undistortion map to the GPU for cv2.cuda.remap.
+- remap_frame_gpu(frame_gpu, map1_gpu, map2_gpu, dst, stream): Undistorts a frame in GPU memory.
+- page_locked_buffer(shape, previous=None): Returns a host buffer registered as page-locked memory for GPU uploads.
+- configure_opencv(): Enables optimized code paths and limits OpenCV's worker threads.
+- parse_array_text(text): Parses a user-typed list such as '[[fx, 0, cx], [0, fy, cy], [0, 0, 1]]' into an array.
+- list_subdirectories(path): Lists the names of the folders in a directory.
 
 Data Sent:
-- precompute_undistort_map: image_shape (tuple of image dimensions).
+- precompute_undistort_map: image_shape (tuple of image dimensions), camera_matrix, dist_coeffs.
+- remap_frame: img (numpy array or cv2.UMat), map1, map2 (from precompute_undistort_map), dst (preallocated output).
 - parse_system_time: system_time_str (string in 'YYYY:MM:DD:HH:MM:SS:MS' format).
+- parse_array_text: text (JSON style list; parentheses and trailing commas are accepted).
+- list_subdirectories: path (directory to scan).
+- page_locked_buffer: shape (of the frames to upload), previous (buffer returned before, reused if the shape matches).
 
 Data Returned:
-- precompute_undistort_map: map1, map2 (undistortion maps), roi (region of interest), new_camera_mtx (new camera matrix).
+- precompute_undistort_map: map1, map2 (undistortion maps producing only the roi part of the frame, None if dist_coeffs
+  are all zero), roi (region of interest in the undistorted frame new_camera_mtx projects to), new_camera_mtx (new camera matrix).
+- remap_frame: The undistorted image (dst itself when a matching buffer is passed, img itself without maps).
 - parse_system_time: timestamp (float representing the time in seconds since the epoch).
+- cuda_available: True if the CUDA ORB/matcher path can be used, otherwise False.
+- opencl_available: True if cv2.UMat operations run on an OpenCL device, otherwise False.
+- upload_undistort_map: map1_gpu, map2_gpu (CV_32FC1 x/y maps as cv2.cuda_GpuMat).
+- remap_frame_gpu: dst (cv2.cuda_GpuMat, written asynchronously on stream), or frame_gpu itself without maps.
+- page_locked_buffer: uint8 numpy array whose memory stays pinned until it is replaced.
+- configure_opencv: Number of threads OpenCV was set to use.
+- parse_array_text: float64 numpy array (raises ValueError if the text is not a numeric list).
+- list_subdirectories: list of folder names (empty if path does not exist).
 """
 
+import os
+import re
+import time
+import json
+import functools
 import cv2
 import numpy as np
 import datetime
@@ -23,19 +54,122 @@ from config import camera_matrix, dist_coeffs
 
 def precompute_undistort_map(image_shape, camera_matrix, dist_coeffs):
     h, w = image_shape[:2]
+    camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+    dist_coeffs = np.asarray(dist_coeffs, dtype=np.float64)
+    return build_undistort_map(h, w, camera_matrix.tobytes(), dist_coeffs.tobytes())
+
+@functools.lru_cache(maxsize=8)
+def build_undistort_map(h, w, camera_matrix_bytes, dist_coeffs_bytes):
+    # Keyed by the matrix contents, so the returned maps are shared and must not be modified
+    camera_matrix = np.frombuffer(camera_matrix_bytes, dtype=np.float64).reshape(3, 3)
+    dist_coeffs = np.frombuffer(dist_coeffs_bytes, dtype=np.float64)
+    if not np.any(dist_coeffs):
+        # Without distortion the undistorted frame is the frame itself; no maps are built
+        return None, None, (0, 0, w, h), camera_matrix
     new_camera_mtx, roi = cv2.getOptimalNewCameraMatrix(
         camera_matrix, dist_coeffs, (w, h), alpha=0, centerPrincipalPoint=1)
+    # Fixed-point CV_16SC2 maps (int16 x/y pairs and uint16 interpolation indices) keep
+    # cv2.remap with INTER_LINEAR on its SIMD path at half the memory of float maps
     map1, map2 = cv2.initUndistortRectifyMap(
         camera_matrix, dist_coeffs, None, new_camera_mtx, (w, h), cv2.CV_16SC2)
+    # Only the pixels inside roi are kept after undistortion, so the maps are cropped to it
+    # and remap never computes the border that would be cut away
+    x, y, roi_w, roi_h = roi
+    map1 = np.ascontiguousarray(map1[y:y+roi_h, x:x+roi_w])
+    map2 = np.ascontiguousarray(map2[y:y+roi_h, x:x+roi_w])
+    map1.flags.writeable = False
+    map2.flags.writeable = False
     return map1, map2, roi, new_camera_mtx
 
+def remap_frame(img, map1, map2, dst=None):
+    if map1 is None:
+        return img
+    # Pass both CV_16SC2 maps as they are; converting them to float maps would leave the fixed-point SIMD path
+    return cv2.remap(img, map1, map2, cv2.INTER_LINEAR, dst=dst, borderMode=cv2.BORDER_CONSTANT)
+
 def parse_system_time(system_time_str):
-    # Parses system time in the format 'YYYY:MM:DD:HH:MM:SS:MS'
+    # Parses system time in the format 'YYYY:MM:DD:HH:MM:SS:MS' (fields need not be zero padded)
     try:
-        parts = system_time_str.split(':')
-        year, month, day, hour, minute, second, millisecond = map(int, parts)
-        dt = datetime.datetime(year, month, day, hour, minute, second, millisecond * 1000)
-        timestamp = dt.timestamp()
-        return timestamp
+        year, month, day, hour, minute, second, millisecond = map(int, system_time_str.split(':'))
+        if not (0 <= minute < 60 and 0 <= second < 60 and 0 <= millisecond < 1000):
+            raise ValueError(system_time_str)
+        return hour_start_timestamp(year, month, day, hour) + minute * 60 + second + millisecond / 1000
     except Exception:
-        return datetime.datetime.now().timestamp()
+        return time.time()
+
+@functools.lru_cache(maxsize=32)
+def hour_start_timestamp(year, month, day, hour):
+    # Local time zone and DST offsets only change on the hour, so the datetime conversion
+    # runs once per hour of data instead of once per frame
+    return datetime.datetime(year, month, day, hour).timestamp()
+
+def cuda_available():
+    # The CUDA feature modules only exist in OpenCV builds with CUDA (contrib) support
+    if not hasattr(cv2, 'cuda_ORB'):
+        return False
+    try:
+        return cv2.cuda.getCudaEnabledDeviceCount() > 0
+    except cv2.error:
+        return False
+
+def opencl_available():
+    if not cv2.ocl.haveOpenCL():
+        return False
+    cv2.ocl.setUseOpenCL(True)
+    return cv2.ocl.useOpenCL()
+
+def upload_undistort_map(map1, map2):
+    if map1 is None:
+        return None, None
+    # cv2.cuda.remap only accepts a pair of CV_32FC1 maps
+    map_x, map_y = cv2.convertMaps(map1, map2, cv2.CV_32FC1)
+    map1_gpu = cv2.cuda_GpuMat()
+    map1_gpu.upload(map_x)
+    map2_gpu = cv2.cuda_GpuMat()
+    map2_gpu.upload(map_y)
+    return map1_gpu, map2_gpu
+
+def remap_frame_gpu(frame_gpu, map1_gpu, map2_gpu, dst, stream):
+    if map1_gpu is None:
+        return frame_gpu
+    cv2.cuda.remap(frame_gpu, map1_gpu, map2_gpu, cv2.INTER_LINEAR, dst=dst,
+                   borderMode=cv2.BORDER_CONSTANT, stream=stream)
+    return dst
+
+def page_locked_buffer(shape, previous=None):
+    # Uploads from pinned memory are asynchronous DMA copies instead of going through a
+    # driver staging copy of pageable memory
+    if previous is not None:
+        if previous.shape == shape:
+            return previous
+        cv2.cuda.unregisterPageLocked(previous)
+    buffer = np.empty(shape, np.uint8)
+    cv2.cuda.registerPageLocked(buffer)
+    return buffer
+
+def configure_opencv():
+    # Use SIMD optimized code paths and about one thread per physical core, leaving room
+    # for the GUI and receiver threads instead of oversubscribing the logical cores
+    cv2.setUseOptimized(True)
+    num_threads = max(1, (os.cpu_count() or 2) // 2)
+    cv2.setNumThreads(num_threads)
+    return num_threads
+
+def parse_array_text(text):
+    # Accept Python style tuples and trailing commas, then parse as JSON instead of
+    # compiling the text as a Python expression
+    text = text.strip().replace('(', '[').replace(')', ']')
+    text = re.sub(r',\s*\]', ']', text)
+    try:
+        return np.array(json.loads(text), dtype=np.float64)
+    except (json.JSONDecodeError, TypeError) as e:
+        raise ValueError(f"Invalid numeric list: {e}")
+
+def list_subdirectories(path):
+    # One directory read; DirEntry.is_dir() uses the file type returned with the entries
+    # instead of a stat call per name
+    try:
+        with os.scandir(path) as entries:
+            return [entry.name for entry in entries if entry.is_dir()]
+    except FileNotFoundError:
+        return []